@@ -0,0 +1,288 @@
+"""
+Benchmarks of the acquisition and reconstruction hot paths.
+
+Runs headless with the bundled phantom mesh and configuration, and frames simulated on that mesh. Results are written
+as JSON, together with the commit and machine they were measured on, so runs can be compared:
+
+    $ python benchmarks/run_benchmarks.py
+    $ python benchmarks/run_benchmarks.py --only parse load --compare benchmarks/results/<earlier run>.json
+
+Times are seconds per call. Benchmarks processing several frames per call also report frames per second.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from multiprocessing import Array, Pipe, Value
+import ctypes
+from itertools import cycle
+from statistics import mean, median
+from time import perf_counter, time
+
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+repository_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository_dir)
+
+from eit_data_acquisition.cache import package_version
+from eit_data_acquisition.eit import setup_eit, setup_forward_model, process_frame, parse_oeit_line, \
+    format_oeit_line, load_oeit_data, load_conf, mesh_geometry, create_solver, create_interpolation
+from eit_data_acquisition.virtual_device import simulated_frames
+from eit_data_acquisition.workers import DataSaver
+from eit_data_acquisition.plotting import EITImageRenderer
+
+configuration_dir = os.path.join(repository_dir, "eit_data_acquisition", "configuration")
+mesh_file = os.path.join(configuration_dir, "circle_phantom_mesh_no_inclusion.stl")
+eit_setup_file = os.path.join(configuration_dir, "eit_setup.json")
+solve_conf_file = os.path.join(configuration_dir, "conf.json")
+gn_conf_file = os.path.join(configuration_dir, "conf_static.json")
+gn_streaming_conf_file = os.path.join(configuration_dir, "conf_gn_streaming.json")
+
+
+def time_function(function, repeat=5, warmup=1, n_items=None):
+    """
+    Time repeat calls of function, after warmup untimed calls.
+
+    Returns
+    -------
+    dict of "min", "median", "mean" and "max" seconds per call, "repeat", and "items_per_second" (from the median) if
+    n_items, the number of frames processed per call, is given
+    """
+    for _ in range(warmup):
+        function()
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        function()
+        times.append(perf_counter() - start)
+    result = {"min": min(times), "median": median(times), "mean": mean(times), "max": max(times), "repeat": repeat}
+    if n_items is not None:
+        result["items_per_second"] = n_items / result["median"]
+    return result
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=repository_dir, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=repository_dir,
+                               capture_output=True, text=True, check=True).stdout.strip() != ""
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = None, None
+
+    uname = platform.uname()
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "date": datetime.now().isoformat(),
+        "machine": {"node": uname.node, "system": uname.system, "release": uname.release, "machine": uname.machine,
+                    "processor": platform.processor(), "cpu_count": os.cpu_count()},
+        "python": platform.python_version(),
+        "packages": {package: package_version(package) for package in ("numpy", "scipy", "pyeit", "matplotlib",
+                                                                       "adv_prodcon")}
+    }
+
+
+def benchmark_parse(frames, repeat):
+    lines = [format_oeit_line(frame) + "\n" for frame in frames]
+
+    def parse_all():
+        for line in lines:
+            parse_oeit_line(line)
+
+    return {"parse_oeit_line": time_function(parse_all, repeat, n_items=len(lines))}
+
+
+def benchmark_load(frames, repeat, directory):
+    file_name = os.path.join(directory, "frames.txt")
+    with open(file_name, "w") as f:
+        f.writelines(format_oeit_line(frame) + "\n" for frame in frames)
+    return {"load_oeit_data": time_function(lambda: load_oeit_data(file_name), repeat, n_items=len(frames))}
+
+
+def benchmark_setup(repeat, directory):
+    cache_directory = os.path.join(directory, "cache")
+    return {
+        # Without a cache every call computes the operators. This takes seconds, so it is only run once
+        "setup_eit_cold": time_function(lambda: setup_eit(mesh_file, eit_setup_file, cache_directory=None),
+                                        repeat=1, warmup=0),
+        "setup_eit_warm": time_function(lambda: setup_eit(mesh_file, eit_setup_file, cache_directory=cache_directory),
+                                        repeat)
+    }
+
+
+def benchmark_process_frame(eit_obj, frames, repeat):
+    background = frames[0]
+    results = {}
+    for name, conf, n_repeat in (("process_frame_solve", load_conf(solve_conf_file), repeat),
+                                 ("process_frame_solve_float32", {**load_conf(solve_conf_file), "dtype": "float32"},
+                                  repeat),
+                                 ("process_frame_gn", load_conf(gn_conf_file), max(1, repeat // 5)),
+                                 ("process_frame_gn_streaming", load_conf(gn_streaming_conf_file), repeat)):
+        solver = create_solver(eit_obj, conf)
+        interpolation = create_interpolation(eit_obj, conf)
+        frame_iterator = cycle(frames)
+
+        def process_next():
+            process_frame(eit_obj, next(frame_iterator), conf, background, solver=solver, interpolation=interpolation)
+
+        results[name] = time_function(process_next, n_repeat)
+    return results
+
+
+def check_precision(eit_obj, frames):
+    """
+    Compare the images reconstructed in float32 with the float64 ones, relative to the largest float64 value of each
+    image.
+
+    Returns
+    -------
+    dict of the "max" and "median" relative error over the frames
+    """
+    background = frames[0]
+    images = {}
+    for dtype in ("float64", "float32"):
+        conf = {**load_conf(solve_conf_file), "dtype": dtype}
+        solver = create_solver(eit_obj, conf)
+        interpolation = create_interpolation(eit_obj, conf)
+        images[dtype] = [process_frame(eit_obj, frame, conf, background, solver=solver, interpolation=interpolation)
+                         for frame in frames[1:]]
+    errors = [np.max(np.abs(single - double)) / np.max(np.abs(double))
+              for single, double in zip(images["float32"], images["float64"])]
+    return {"max": float(np.max(errors)), "median": float(np.median(errors))}
+
+
+def benchmark_data_saver(frames, repeat, directory):
+    """
+    Time DataSaver.work in this process on a batch of Reader messages, for csv and binary recordings.
+    """
+    messages = [{"tag": "EIT", "data": frame, "timestamp": time() + i / 1000} for i, frame in enumerate(frames)]
+    _, message_pipe = Pipe()
+    results = {}
+    for file_type in ("csv", "binary"):
+        configuration = {"directory": os.path.join(directory, "data") + os.sep, "format": "%Y-%m-%dT%H_%M_eit",
+                         "default_suffix": "benchmark", "columns": ["Time", "EIT"], "timestamp_format": "raw",
+                         "delimiter": ",", "extension": ".csv", "file_type": file_type,
+                         "binary_extension": ".eitrec", "flush_interval": 1}
+        kwargs = {"filename": Array(ctypes.c_char, 4096), "n_dropped": Value(ctypes.c_longlong, 0), "suffix": file_type,
+                  "configuration": configuration}
+        shared_var = DataSaver.on_start(None, message_pipe, **kwargs)
+        results["data_saver_" + file_type] = time_function(
+            lambda: DataSaver.work([messages], shared_var, None, message_pipe, **kwargs), repeat, n_items=len(messages))
+        DataSaver.on_stop(shared_var, None, message_pipe, **kwargs)
+    return results
+
+
+def benchmark_render(eit_obj, frames, repeat):
+    """
+    Time drawing images with EITImageRenderer on an offscreen Agg canvas: a full figure draw, and the blitted update
+    used while the colour scale is unchanged.
+    """
+    geometry = mesh_geometry(eit_obj)
+    images = [process_frame(eit_obj, frame, load_conf(solve_conf_file), frames[0]) for frame in frames[:20]]
+    results = {}
+    for mode in ("mesh", "grid"):
+        figure = Figure()
+        canvas = FigureCanvasAgg(figure)
+        renderer = EITImageRenderer(figure, geometry, color_scale="fixed", fixed_scale=(-1, 1), mode=mode)
+        canvas.draw()
+        image_iterator = cycle(images)
+
+        def full_draw():
+            renderer.update(next(image_iterator))
+            canvas.draw()
+
+        def blit_update():
+            renderer.update(next(image_iterator))
+
+        results["render_{}_full".format(mode)] = time_function(full_draw, repeat)
+        results["render_{}_blit".format(mode)] = time_function(blit_update, repeat)
+    return results
+
+
+def compare(results, previous):
+    """
+    Print the ratio of the current to the previous time of each benchmark in both runs. Benchmarks processing several
+    frames per call are compared per frame, so runs with different --frames can be compared.
+    """
+    def seconds(stats):
+        return 1 / stats["items_per_second"] if "items_per_second" in stats else stats["median"]
+
+    print("{:28s}{:>14s}{:>14s}{:>9s}".format("benchmark", "previous (s)", "current (s)", "ratio"))
+    for name, stats in results["benchmarks"].items():
+        if name in previous["benchmarks"]:
+            old = seconds(previous["benchmarks"][name])
+            new = seconds(stats)
+            print("{:28s}{:14.6f}{:14.6f}{:9.2f}".format(name, old, new, new / old))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", help="Result file. Defaults to benchmarks/results/<date>_<commit>_<machine>.json")
+    parser.add_argument("--repeat", type=int, default=10, help="Timed calls per benchmark")
+    parser.add_argument("--frames", type=int, default=200, help="Number of synthetic frames")
+    parser.add_argument("--only", nargs="+", help="Only run these groups: parse load setup process saver render")
+    parser.add_argument("--compare", help="Earlier result file to compare with")
+    args = parser.parse_args()
+
+    def selected(group):
+        return args.only is None or group in args.only
+
+    results = {"environment": environment(), "parameters": {"repeat": args.repeat, "frames": args.frames},
+               "benchmarks": {}}
+    benchmarks = results["benchmarks"]
+
+    # One breathing cycle of args.frames frames
+    frames, _ = simulated_frames(setup_forward_model(mesh_file, eit_setup_file, cache_directory=None),
+                                 frame_rate=0.25 * args.frames, breathing_rate=0.25)
+
+    with tempfile.TemporaryDirectory() as directory:
+        if selected("parse"):
+            benchmarks.update(benchmark_parse(frames, args.repeat))
+        if selected("load"):
+            benchmarks.update(benchmark_load(frames, args.repeat, directory))
+        if selected("setup"):
+            benchmarks.update(benchmark_setup(args.repeat, directory))
+        if selected("process") or selected("render"):
+            eit_obj = setup_eit(mesh_file, eit_setup_file, cache_directory=os.path.join(directory, "cache"))
+            if selected("process"):
+                benchmarks.update(benchmark_process_frame(eit_obj, frames, args.repeat))
+                results["float32_error"] = check_precision(eit_obj, frames)
+            if selected("render"):
+                benchmarks.update(benchmark_render(eit_obj, frames, args.repeat))
+        if selected("saver"):
+            benchmarks.update(benchmark_data_saver(frames, args.repeat, directory))
+
+    output = args.output
+    if output is None:
+        commit = results["environment"]["commit"]
+        output = os.path.join(repository_dir, "benchmarks", "results", "{}_{}_{}.json".format(
+            datetime.now().strftime("%Y-%m-%dT%H_%M_%S"), commit[:8] if commit else "unknown", platform.node()))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    for name, stats in benchmarks.items():
+        rate = " ({:.0f} frames/s)".format(stats["items_per_second"]) if "items_per_second" in stats else ""
+        print("{:28s}{:12.6f} s{}".format(name, stats["median"], rate))
+    if "float32_error" in results:
+        print("float32 images differ from float64 by {:.1e} (max), {:.1e} (median) of their maximum".format(
+            results["float32_error"]["max"], results["float32_error"]["median"]))
+    print("Results written to " + output)
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
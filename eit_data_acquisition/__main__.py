@@ -1,22 +1,130 @@
 import argparse
+import glob
 import shutil
 
-import PyInstaller.__main__
 import os
 import eit_data_acquisition
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--install", help="Install the app",  action="store_true")
+    subparsers = parser.add_subparsers(dest="command")
+
+    virtual_parser = subparsers.add_parser("virtual-device", help="Serve a simulated or replayed EIT device on a "
+                                                                  "pseudo-terminal")
+    virtual_parser.add_argument("--replay", help="Recording to replay instead of simulating frames")
+    virtual_parser.add_argument("--rate-multiplier", type=float, default=1, help="Replay speed")
+    virtual_parser.add_argument("--frame-rate", type=float, default=50,
+                                help="Simulated frame rate, or replay rate of files without timestamps")
+    virtual_parser.add_argument("--noise", type=float, default=0.01, help="Simulated noise level")
+    virtual_parser.add_argument("--no-loop", action="store_true", help="Stop after the last frame")
+    virtual_parser.add_argument("--mesh", default=os.path.join("configuration", "circle_phantom_mesh_no_inclusion.stl"))
+    virtual_parser.add_argument("--eit-setup", default=os.path.join("configuration", "eit_setup.json"))
+
+    headless_parser = subparsers.add_parser("headless", help="Acquire, reconstruct and record without a GUI")
+    headless_parser.add_argument("--device", required=True, nargs="+",
+                                 help='Serial port, "Virtual EIT", or "Replay: <file>" to replay a recording. Several '
+                                      'devices are read at once and their frames aligned by time')
+    headless_parser.add_argument("--duration", type=float, help="Seconds to run for. Runs until interrupted if not set")
+    headless_parser.add_argument("--output-dir", help="Directory to record to. Nothing is recorded if not set")
+    headless_parser.add_argument("--suffix", default="", help="Suffix of the recording's file name")
+    headless_parser.add_argument("--file-type", choices=["csv", "binary"], default="csv")
+    headless_parser.add_argument("--compress", action="store_true", help="Gzip compress the recording")
+    headless_parser.add_argument("--compression-level", type=int, default=6, help="1 (fastest) to 9 (smallest)")
+    headless_parser.add_argument("--rotate-size", type=float, help="Start a new segment every this many MB")
+    headless_parser.add_argument("--rotate-duration", type=float, help="Start a new segment every this many seconds")
+    headless_parser.add_argument("--record-images", action="store_true",
+                                 help="Also record the reconstructed images in the output directory")
+    headless_parser.add_argument("--no-reconstruction", action="store_true", help="Only record the frames")
+    headless_parser.add_argument("--conf", default=os.path.join("configuration", "conf.json"))
+    headless_parser.add_argument("--mesh", default=os.path.join("configuration", "circle_phantom_mesh_no_inclusion.stl"))
+    headless_parser.add_argument("--eit-setup", default=os.path.join("configuration", "eit_setup.json"))
+    headless_parser.add_argument("--background", help="File with the background frame")
+    headless_parser.add_argument("--lossless", action="store_true", help="Reconstruct every frame in a process pool")
+    headless_parser.add_argument("--workers", type=int, help="Number of reconstruction processes with --lossless")
+    headless_parser.add_argument("--metrics-file", help="File to append pipeline metrics to as JSON lines")
+
+    filter_parser = subparsers.add_parser("filter", help="Filter the frames of a recording over time, like the EIT "
+                                                         "processor does with the configuration's filter")
+    filter_parser.add_argument("recording", help="Recording or frame file to filter")
+    filter_parser.add_argument("output", help="csv file to write the filtered frames to")
+    filter_parser.add_argument("--conf", default=os.path.join("configuration", "conf_breathing.json"),
+                               help='Reconstruction configuration with the "filter" to apply')
+    filter_parser.add_argument("--tag", default="EIT", help="Device to filter in recordings of several devices. Its "
+                                                            "frames are written to the EIT column of the output")
     args = parser.parse_args()
 
     if args.install is not False:
         install()
+    elif args.command == "virtual-device":
+        serve_virtual_device(args)
+    elif args.command == "headless":
+        run_headless(args)
+    elif args.command == "filter":
+        filter_recording(args)
     else:
         print("No action specified")
 
 
+def serve_virtual_device(args):
+    from eit_data_acquisition.virtual_device import (virtual_device_name, replay_device_prefix, open_virtual_device,
+                                                     serve_on_pty)
+
+    package_dir = os.path.dirname(eit_data_acquisition.__file__)
+    device_name = virtual_device_name if args.replay is None else replay_device_prefix + args.replay
+    configuration = {
+        "mesh": os.path.join(package_dir, args.mesh),
+        "eit_setup": os.path.join(package_dir, args.eit_setup),
+        "frame_rate": args.frame_rate,
+        "rate_multiplier": args.rate_multiplier,
+        "noise": args.noise,
+        "loop": not args.no_loop
+    }
+    serve_on_pty(open_virtual_device(device_name, configuration))
+
+
+def run_headless(args):
+    from eit_data_acquisition import headless
+
+    package_dir = os.path.dirname(eit_data_acquisition.__file__)
+    mesh = os.path.join(package_dir, args.mesh)
+    eit_setup = os.path.join(package_dir, args.eit_setup)
+    headless.device_configuration["virtual_device"].update({"mesh": mesh, "eit_setup": eit_setup})
+    headless.run_headless(args.device, duration=args.duration, output_directory=args.output_dir, suffix=args.suffix,
+                          file_type=args.file_type, reconstruct=not args.no_reconstruction, mesh=mesh,
+                          eit_setup=eit_setup, conf=os.path.join(package_dir, args.conf),
+                          initial_background=args.background, lossless=args.lossless, n_workers=args.workers,
+                          metrics_file=args.metrics_file, recording_options={
+                              "compression": "gzip" if args.compress else None,
+                              "compression_level": args.compression_level,
+                              "rotate_size": None if args.rotate_size is None else int(args.rotate_size * 1e6),
+                              "rotate_duration": args.rotate_duration}, record_images=args.record_images)
+
+
+def filter_recording(args):
+    import csv
+    from eit_data_acquisition.eit import load_conf, format_oeit_line
+    from eit_data_acquisition.filters import filter_recording
+
+    conf = load_conf(os.path.join(os.path.dirname(eit_data_acquisition.__file__), args.conf))
+    if "filter" not in conf:
+        print("No filter in " + args.conf)
+        return
+    if os.path.exists(args.output):
+        print(args.output + " already exists")
+        return
+    frames, frame_times = filter_recording(args.recording, conf["filter"], args.tag)
+    # Written like a csv recording of a single device with raw timestamps, so it can be replayed
+    with open(args.output, "x", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Time", "EIT"])
+        writer.writerows([frame_time, format_oeit_line(frame)] for frame_time, frame in zip(frame_times, frames))
+    print("Filtered {} frames to {}".format(len(frames), args.output))
+
+
 def install():
+    import PyInstaller.__main__
+
     package_dir = os.path.dirname(eit_data_acquisition.__file__)
     working_dir = os.getcwd()
     workpath = os.path.join(working_dir, "build")
@@ -26,21 +134,20 @@ def install():
     app_path = os.path.join(package_dir, "main.py")
     layout_path = os.path.join(package_dir, "layout", "layout.ui")
     lung_icon_path = os.path.join(package_dir, "layout", "lung_icon.PNG")
-    conf_path = os.path.join(package_dir, "configuration", "conf.json")
-    eit_setup_path = os.path.join(package_dir, "configuration", "eit_setup.json")
+    # Every configuration, so that all of them can be chosen in the installed app
+    conf_paths = sorted(glob.glob(os.path.join(package_dir, "configuration", "*.json")))
     mesh_path = os.path.join(package_dir, "configuration", "circle_phantom_mesh_no_inclusion.stl")
 
     if os.path.exists(distpath):
         shutil.rmtree(distpath)
 
     sep = os.pathsep
+    add_data = ["--add-data=" + path + sep + "configuration" for path in conf_paths + [mesh_path]]
     PyInstaller.__main__.run([
         app_path,
         "--add-data=" + layout_path + sep + "layout",
         "--add-data=" + lung_icon_path + sep + "layout",
-        "--add-data=" + conf_path + sep + "configuration",
-        "--add-data=" + eit_setup_path + sep + "configuration",
-        "--add-data=" + mesh_path + sep + "configuration",
+        *add_data,
         "--windowed",
         "--workpath=" + workpath,
         "--distpath=" + distpath,
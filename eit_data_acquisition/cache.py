@@ -0,0 +1,92 @@
+"""
+On-disk cache for expensive EIT setup results.
+
+Entries are directories of .npy files keyed by a hash of everything the result depends on (input file contents and
+configuration). A changed input produces a new key, so stale entries are never loaded. Entries are written to a temporary
+directory and renamed into place, so a crash while saving never leaves a half written entry behind.
+"""
+
+import hashlib
+from importlib import metadata
+import json
+import os
+import shutil
+import numpy as np
+
+# Next to the package rather than in the working directory, so that every way of starting the app shares one cache
+default_cache_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+
+cache_stats = {}
+
+
+def file_hash(file_name):
+    sha = hashlib.sha256()
+    with open(file_name, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def package_version(package):
+    try:
+        return metadata.version(package)
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def cache_key(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def record_cache_result(kind, hit):
+    stats = cache_stats.setdefault(kind, {"hits": 0, "misses": 0})
+    stats["hits" if hit else "misses"] += 1
+    print("{} cache {}".format(kind, "hit" if hit else "miss"))
+
+
+def entry_path(cache_directory, kind, key):
+    return os.path.join(cache_directory, kind + "_" + key)
+
+
+def load_cache_entry(cache_directory, kind, key, mmap_mode=None):
+    """
+    Load the arrays stored under key, or return None on a miss. Hits and misses are counted in cache_stats.
+
+    Parameters
+    ----------
+    cache_directory
+    kind: name of the cached object, e.g. "operator" or "mesh"
+    key: from cache_key
+    mmap_mode: passed to np.load. Use "r" to memory map large arrays instead of reading them
+
+    Returns
+    -------
+    dict of array name to array, or None
+    """
+    path = entry_path(cache_directory, kind, key)
+    try:
+        arrays = {file_name[:-len(".npy")]: np.load(os.path.join(path, file_name), mmap_mode=mmap_mode)
+                  for file_name in os.listdir(path) if file_name.endswith(".npy")}
+    except (OSError, ValueError):
+        arrays = None
+    if not arrays:
+        arrays = None
+
+    record_cache_result(kind, arrays is not None)
+    return arrays
+
+
+def save_cache_entry(cache_directory, kind, key, arrays):
+    path = entry_path(cache_directory, kind, key)
+    tmp_path = path + ".tmp" + str(os.getpid())
+    try:
+        os.makedirs(tmp_path, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, name + ".npy"), np.asarray(array))
+        os.rename(tmp_path, path)
+    except OSError as e:
+        # If another process saved the same entry first, that one is used. Otherwise (e.g. the cache directory is not
+        # writable) carry on without the cache, which is an optimization only.
+        if not os.path.isdir(path):
+            print(e)
+        shutil.rmtree(tmp_path, ignore_errors=True)
@@ -0,0 +1,65 @@
+from collections import deque
+from itertools import islice
+from PyQt5 import QtCore
+
+
+class RawDataConsole(QtCore.QObject):
+    """
+    Shows the most recent raw data lines in a text widget without slowing down the GUI.
+
+    Appending only stores the item in a ring buffer of max_lines items. A timer writes the items added since the last
+    flush to the widget in one batch, at most max_rate times per second, and the widget's document is capped at
+    max_lines blocks so memory stays bounded however long acquisition runs. Items are converted to text with formatter
+    only when they are flushed, so items that are overwritten before a flush cost nothing. While paused, items are still
+    buffered but the widget is not updated.
+    """
+    def __init__(self, text_edit, max_lines=500, max_rate=10, formatter=str, parent=None):
+        super().__init__(parent)
+        self.text_edit = text_edit
+        self.formatter = formatter
+        self.items = deque(maxlen=max_lines)
+        self.n_new = 0
+        self.paused = False
+
+        text_edit.document().setMaximumBlockCount(max_lines)
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(int(1000 / max_rate))
+        self.timer.timeout.connect(self.flush)
+        self.timer.start()
+
+    def append(self, item):
+        self.items.append(item)
+        self.n_new += 1
+
+    def set_paused(self, paused):
+        self.paused = paused
+        if not paused:
+            self.flush()
+
+    def clear(self):
+        self.items.clear()
+        self.n_new = 0
+        self.text_edit.clear()
+
+    def flush(self):
+        if self.paused or self.n_new == 0:
+            return
+        n_new = min(self.n_new, len(self.items))
+        self.n_new = 0
+
+        lines = [self.formatter(item) for item in islice(self.items, len(self.items) - n_new, None)]
+        lines = [line.rstrip("\n") for line in lines if line is not None]
+        if len(lines) == 0:
+            return
+
+        scroll_bar = self.text_edit.verticalScrollBar()
+        at_bottom = scroll_bar.value() == scroll_bar.maximum()
+
+        cursor = self.text_edit.textCursor()
+        cursor.movePosition(cursor.End)
+        if not self.text_edit.document().isEmpty():
+            cursor.insertBlock()
+        cursor.insertText("\n".join(lines))
+
+        if at_bottom:
+            scroll_bar.setValue(scroll_bar.maximum())
@@ -1,13 +1,17 @@
-from pyeit.eit.base import EitBase
-from pyeit.eit.interp2d import sim2pts
 import json
+from itertools import islice
 import numpy as np
-from pyeit.mesh.external import load_mesh, place_electrodes_equal_spacing
-from pyeit.eit.jac import JAC
-from pyeit.eit.utils import eit_scan_lines
-import pyeit.eit.protocol as protocol
 import pathlib
 import os
+from typing import TYPE_CHECKING
+from eit_data_acquisition.metrics import stamp
+from eit_data_acquisition.cache import default_cache_directory, file_hash, cache_key, package_version, \
+    load_cache_entry, save_cache_entry
+
+# pyeit (which imports matplotlib) is only imported by the functions that use it, so frame parsing and formatting can be
+# used in processes that don't reconstruct images, without loading it
+if TYPE_CHECKING:
+    from pyeit.eit.base import EitBase
 
 
 def load_conf(conf_file):
@@ -15,44 +19,151 @@ def load_conf(conf_file):
         return json.load(f)
 
 
-def process_frame(pyeit_obj: EitBase, frame, conf, background):
+def reconstruction_dtype(conf):
+    """
+    Precision of the reconstruction operators and images: conf["dtype"], "float64" (default) or "float32".
+    """
+    return np.dtype(conf.get("dtype", "float64"))
+
+
+def process_frame(pyeit_obj: "EitBase", frame, conf, background, stage_times=None, solver=None, interpolation=None):
+    """
+    Reconstruct the node values of one frame. If a stage_times dict is given, the times the solve and sim2pts stages
+    finished are added to it (see metrics).
+
+    solver and interpolation are the operators precomputed by create_solver and create_interpolation, which make the
+    image conf["dtype"]. The "gn_streaming" solve type needs the solver, which carries the reconstruction over from one
+    frame to the next. Without them the frame is reconstructed by pyeit directly, in float64.
+    """
     if background is None:
         background = np.zeros(len(frame))
 
     if conf["solve_type"] == "solve":
-        ds = pyeit_obj.solve(frame, background, conf["normalize"])
-        ds_jac = sim2pts(pyeit_obj.mesh.node, pyeit_obj.mesh.element, ds)
-        eit_image = np.real(ds_jac)
+        if solver is not None:
+            ds = solver.solve(frame, background)
+        else:
+            ds = pyeit_obj.solve(frame, background, conf["normalize"])
     elif conf["solve_type"] == "gn":
         ds = pyeit_obj.gn(frame, lamb_decay=conf["solve_params"]["lamb_decay"],
-                          lamb_min=conf["solve_params"]["lamb_min"], maxiter=conf["solve_params"]["maxiter"],
-                          verbose=True)
-        ds_jac = sim2pts(pyeit_obj.mesh.node, pyeit_obj.mesh.element, ds)
-        eit_image = np.real(ds_jac)
+                          lamb_min=conf["solve_params"]["lamb_min"], maxiter=conf["solve_params"]["maxiter"])
+    elif conf["solve_type"] == "gn_streaming":
+        ds = solver.solve(frame)
     else:
-        eit_image = None
+        return None
+    stamp(stage_times, "solve")
 
+    if interpolation is not None:
+        eit_image = interpolation @ np.real(ds).astype(interpolation.dtype, copy=False)
+    else:
+        from pyeit.eit.interp2d import sim2pts
+        eit_image = np.real(sim2pts(pyeit_obj.mesh.node, pyeit_obj.mesh.element, ds))
+    stamp(stage_times, "sim2pts")
     return eit_image
 
 
-def load_oeit_data(file_name):
+def create_solver(pyeit_obj: "EitBase", conf):
+    """
+    Create the solver that process_frame uses for conf's solve type: the reconstruction matrix in conf["dtype"] for
+    "solve", and the state carried over between frames for "gn_streaming". None for "gn", which pyeit solves.
+    """
+    if conf["solve_type"] == "solve":
+        from eit_data_acquisition.linear_solver import LinearSolver
+        return LinearSolver(pyeit_obj, reconstruction_dtype(conf), conf["normalize"])
+    if conf["solve_type"] == "gn_streaming":
+        from eit_data_acquisition.streaming_gn import StreamingGaussNewton
+        return StreamingGaussNewton(pyeit_obj, **conf.get("solve_params", {}))
+    return None
+
+
+def create_interpolation(pyeit_obj: "EitBase", conf):
+    """
+    Create the sparse matrix interpolating element values to the nodes for process_frame, in conf["dtype"].
+    """
+    return element_to_node_matrix(pyeit_obj.mesh.node, pyeit_obj.mesh.element, reconstruction_dtype(conf))
+
+
+def element_to_node_matrix(node, element, dtype=np.float64):
+    """
+    Sparse (n_nodes x n_elements) matrix giving each node the mean of the values of the elements it belongs to,
+    weighted by their areas (volumes for tetrahedra), like pyeit's sim2pts. sim2pts builds this matrix, and a dense
+    copy of it, on every call.
+    """
+    from scipy.sparse import coo_matrix, diags
+
+    n_elements, n_vertices = element.shape
+    if n_vertices == 3:
+        xy = node[element][:, :, :2]
+        a = xy[:, 2] - xy[:, 1]
+        b = xy[:, 0] - xy[:, 2]
+        weights = 0.5 * (a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0])
+    else:
+        from pyeit.eit.interp2d import tet_volume
+        weights = tet_volume(node, element)
+
+    e2n = coo_matrix((np.repeat(weights, n_vertices), (element.ravel(), np.repeat(np.arange(n_elements), n_vertices))),
+                     shape=(len(node), n_elements)).tocsr()
+    with np.errstate(divide="ignore"):
+        e2n = diags(1 / np.asarray(e2n.sum(axis=1)).ravel()) @ e2n
+    return e2n.astype(dtype).tocsr()
+
+
+def mesh_geometry(pyeit_obj: "EitBase"):
+    """
+    Get the mesh geometry needed to draw images: node coordinates, triangles and electrode coordinates.
+    """
+    node = pyeit_obj.mesh.node
+    return {"x": node[:, 0], "y": node[:, 1], "triangles": pyeit_obj.mesh.element,
+            "electrode_points": node[pyeit_obj.mesh.el_pos, :2]}
+
+
+def load_oeit_data(file_name, n_frames=None):
+    """
+    Load the frames of a file with one frame per line, or only its first n_frames valid frames, in which case the rest
+    of the file isn't read. Lines that aren't valid frames are skipped.
+    """
     with open(file_name, "r") as f:
-        lines = f.readlines()
+        if n_frames is None:
+            return parse_oeit_lines(f.readlines())
+        lines = []
+        frames = parse_oeit_lines(lines)
+        while len(frames) < n_frames:
+            new_lines = list(islice(f, n_frames - len(frames)))
+            if len(new_lines) == 0:
+                break
+            lines.extend(new_lines)
+            frames = parse_oeit_lines(lines)
+
+    return frames[:n_frames]
 
-    data = []
-    for line in lines:
-        eit = parse_oeit_line(line)
-        if eit is not None:
-            data.append(eit)
 
-    return data
+def load_background(file_name, n_frames=1):
+    """
+    Load a background frame: the mean of the first n_frames valid frames of the file (see load_oeit_data).
+    """
+    frames = load_oeit_data(file_name, n_frames)
+    if len(frames) < n_frames:
+        raise ValueError("{} has {} valid frames, the background needs {}".format(file_name, len(frames), n_frames))
+    return frames.mean(axis=0)
 
 
 def parse_oeit_line(line):
+    """
+    Parse a line of the form "prefix: item, item, ..." into a float array. Empty items are skipped. Returns None if the
+    line has no prefix or any item is not a number.
+    """
     try:
         _, data = line.split(":", 1)
     except (ValueError, AttributeError):
         return None
+    try:
+        # Fast path: let numpy convert all items at once. Only trailing separators are expected to leave empty items
+        return np.array(data.strip().rstrip(",").split(","), dtype=float)
+    except ValueError:
+        return parse_oeit_items(data)
+
+
+def parse_oeit_items(data):
+    # Item by item parsing, used to apply the rejection rules exactly when the fast path fails
     items = []
     for item in data.split(","):
         item = item.strip()
@@ -65,12 +176,64 @@ def parse_oeit_line(line):
     return np.array(items)
 
 
-def setup_eit(mesh_file_name, conf_file_name):
-    with open(conf_file_name, "r") as f:
-        conf = json.load(f)
-    elec_conf = conf["electrodes"]
-    ex_mat_conf = conf["ex_mat"]
-    setup = conf["setup"]
+def parse_oeit_lines(lines):
+    """
+    Parse a block of lines into an (n_frames x n_items) float array in one numpy call.
+
+    Lines are rejected by the same rules as parse_oeit_line. Empty frames are dropped, and since the result is a 2D
+    array, so are frames whose length differs from the first valid frame.
+    """
+    payloads = []
+    for line in lines:
+        try:
+            payload = line.split(":", 1)[1].strip().rstrip(",")
+        except (IndexError, AttributeError):
+            continue
+        if payload:
+            payloads.append(payload)
+
+    if len(payloads) == 0:
+        return np.empty((0, 0))
+
+    try:
+        return np.loadtxt(payloads, delimiter=",", comments=None, ndmin=2)
+    except ValueError:
+        # Malformed or ragged lines somewhere in the block. Fall back to parsing line by line
+        frames = [parse_oeit_items(payload) for payload in payloads]
+        frames = [frame for frame in frames if frame is not None and len(frame) > 0]
+        if len(frames) == 0:
+            return np.empty((0, 0))
+        return np.array([frame for frame in frames if len(frame) == len(frames[0])])
+
+
+def format_oeit_line(frame, prefix="magnitudes: ", separator=", "):
+    return prefix + "".join(("{}" + separator).format(item) for item in frame)
+
+
+def load_mesh_with_electrodes(mesh_file_name, elec_conf, cache_directory=default_cache_directory, mesh_hash=None):
+    """
+    Load a mesh and place electrodes on it as described by elec_conf.
+
+    Parsing the mesh file and placing the electrodes is done once per mesh file and electrode configuration. The
+    resulting nodes, elements, permittivity, electrode positions and reference node are cached as binary arrays in
+    cache_directory. The cache key includes a hash of the mesh file contents, so editing the mesh or electrode
+    configuration invalidates the cached copy. Set cache_directory to None to always parse the mesh file.
+    """
+    from pyeit.mesh import PyEITMesh
+    from pyeit.mesh.external import load_mesh, place_electrodes_equal_spacing
+
+    if cache_directory is not None:
+        if mesh_hash is None:
+            mesh_hash = file_hash(mesh_file_name)
+        # The layout version keeps entries saved before ref_node was cached from shadowing the new ones
+        key = cache_key(mesh_hash, elec_conf, package_version("pyeit"), 2)
+        arrays = load_cache_entry(cache_directory, "mesh", key)
+    else:
+        key, arrays = None, None
+
+    if arrays is not None and {"node", "element", "perm", "el_pos", "ref_node"} <= arrays.keys():
+        return PyEITMesh(node=arrays["node"], element=arrays["element"], perm=arrays["perm"], el_pos=arrays["el_pos"],
+                         ref_node=int(arrays["ref_node"]))
 
     mesh_obj = load_mesh(mesh_file_name)
 
@@ -81,11 +244,82 @@ def setup_eit(mesh_file_name, conf_file_name):
 
     mesh_obj.el_pos = np.array(electrode_nodes)
 
+    if key is not None:
+        save_cache_entry(cache_directory, "mesh", key, {"node": mesh_obj.node, "element": mesh_obj.element,
+                                                        "perm": mesh_obj.perm, "el_pos": mesh_obj.el_pos,
+                                                        "ref_node": mesh_obj.ref_node})
+    return mesh_obj
+
+
+def setup_eit(mesh_file_name, conf_file_name, cache_directory=default_cache_directory):
+    """
+    Load the mesh, place electrodes and build the reconstruction object described by conf_file_name.
+
+    The mesh (see load_mesh_with_electrodes) and the JAC operators (Jacobian, reference voltages and reconstruction
+    matrix H), which take seconds to compute, are cached in cache_directory, keyed by the mesh file contents and the
+    configuration. Set cache_directory to None to always recompute.
+    """
+    from pyeit.eit.jac import JAC
+    import pyeit.eit.protocol as protocol
+
+    with open(conf_file_name, "r") as f:
+        conf = json.load(f)
+    elec_conf = conf["electrodes"]
+    ex_mat_conf = conf["ex_mat"]
+    setup = conf["setup"]
+
+    mesh_hash = file_hash(mesh_file_name) if cache_directory is not None else None
+    mesh_obj = load_mesh_with_electrodes(mesh_file_name, elec_conf, cache_directory, mesh_hash)
+
     if conf["type"] == "JAC":
         protocol_obj = protocol.create(elec_conf["number"], dist_exc=ex_mat_conf["dist"], step_meas=ex_mat_conf["step"], parser_meas=conf["parser"])
         pyeit_obj = JAC(mesh_obj, protocol_obj)
-        pyeit_obj.setup(p=setup["p"], lamb=setup["lamb"], method=setup["method"])
+        if cache_directory is not None:
+            key = cache_key(mesh_hash, elec_conf, ex_mat_conf, conf["parser"], setup, package_version("pyeit"))
+            operator = load_cache_entry(cache_directory, "operator", key, mmap_mode="r")
+        else:
+            key, operator = None, None
+
+        if operator is not None and {"J", "v0", "H"} <= operator.keys():
+            pyeit_obj.params = {"p": setup["p"], "lamb": setup["lamb"], "method": setup["method"],
+                                "jac_normalize": False}
+            pyeit_obj.J, pyeit_obj.v0, pyeit_obj.H = operator["J"], operator["v0"], operator["H"]
+            pyeit_obj.is_ready = True
+        else:
+            pyeit_obj.setup(p=setup["p"], lamb=setup["lamb"], method=setup["method"])
+            if key is not None:
+                save_cache_entry(cache_directory, "operator", key,
+                                 {"J": pyeit_obj.J, "v0": pyeit_obj.v0, "H": pyeit_obj.H})
     else:
         pyeit_obj = None
 
-    return pyeit_obj
\ No newline at end of file
+    return pyeit_obj
+
+
+def setup_forward_model(mesh_file_name, conf_file_name, cache_directory=default_cache_directory):
+    """
+    Build only the forward model (mesh, electrodes and measurement protocol) described by conf_file_name, for
+    simulating measurements. Much cheaper than setup_eit, which also computes the reconstruction operators.
+    """
+    from pyeit.eit.fem import EITForward
+    import pyeit.eit.protocol as protocol
+
+    conf = load_conf(conf_file_name)
+    elec_conf = conf["electrodes"]
+    ex_mat_conf = conf["ex_mat"]
+    mesh_obj = load_mesh_with_electrodes(mesh_file_name, elec_conf, cache_directory)
+    protocol_obj = protocol.create(elec_conf["number"], dist_exc=ex_mat_conf["dist"], step_meas=ex_mat_conf["step"],
+                                   parser_meas=conf["parser"])
+    return EITForward(mesh_obj, protocol_obj)
+
+
+def measurement_count(conf_file_name):
+    """
+    Number of measurements in a frame of the protocol described by conf_file_name.
+    """
+    import pyeit.eit.protocol as protocol
+
+    conf = load_conf(conf_file_name)
+    protocol_obj = protocol.create(conf["electrodes"]["number"], dist_exc=conf["ex_mat"]["dist"],
+                                   step_meas=conf["ex_mat"]["step"], parser_meas=conf["parser"])
+    return protocol_obj.n_meas_tot
@@ -0,0 +1,170 @@
+"""
+Temporal filtering of the frame stream, each measurement channel separately.
+
+The filter is described by a dict, the "filter" entry of the reconstruction configuration:
+    "design": "iir" (Butterworth, applied as second-order sections, default) or "fir" (windowed, firwin)
+    "btype": "lowpass", "highpass", "bandpass" or "bandstop"
+    "cutoff": cutoff frequency in Hz, or [low, high] for band filters
+    "order": order of the IIR filter (default 4)
+    "numtaps": number of taps of the FIR filter (default 51)
+    "frame_rate": frame rate in frames per second the filter is designed for
+"""
+
+from collections import deque
+import numpy as np
+
+
+def design_filter(filter_conf):
+    """
+    Design the filter described by filter_conf.
+
+    Returns
+    -------
+    ("sos", (n_sections x 6) array) for IIR filters, or ("fir", (numtaps,) array of taps)
+    """
+    from scipy import signal
+
+    design = filter_conf.get("design", "iir")
+    if design == "iir":
+        return "sos", signal.butter(filter_conf.get("order", 4), filter_conf["cutoff"], btype=filter_conf["btype"],
+                                    fs=filter_conf["frame_rate"], output="sos")
+    elif design == "fir":
+        pass_zero = filter_conf["btype"] in ("lowpass", "bandstop")
+        return "fir", signal.firwin(filter_conf.get("numtaps", 51), filter_conf["cutoff"], pass_zero=pass_zero,
+                                    fs=filter_conf["frame_rate"])
+    raise ValueError("Unknown filter design: " + str(design))
+
+
+class FrameFilter:
+    """
+    Filters frames over time, keeping the state between calls. The state starts as if the first frame had always been
+    measured, so there is no start up transient.
+    """
+    def __init__(self, filter_conf):
+        self.kind, self.coefficients = design_filter(filter_conf)
+        self.state = None
+
+    def reset(self):
+        self.state = None
+
+    def initial_state(self, frame):
+        from scipy import signal
+
+        if self.kind == "sos":
+            return signal.sosfilt_zi(self.coefficients)[:, :, None] * frame
+        return signal.lfilter_zi(self.coefficients, 1)[:, None] * frame
+
+    def filter(self, frames):
+        """
+        Filter an (n_frames x n_channels) array of consecutive frames, following the frames of the previous call.
+        """
+        from scipy import signal
+
+        frames = np.asarray(frames, dtype=float)
+        if len(frames) == 0:
+            return frames
+        if self.state is None:
+            self.state = self.initial_state(frames[0])
+        if self.kind == "sos":
+            filtered, self.state = signal.sosfilt(self.coefficients, frames, axis=0, zi=self.state)
+        else:
+            filtered, self.state = signal.lfilter(self.coefficients, 1, frames, axis=0, zi=self.state)
+        return filtered
+
+
+def create_frame_filter(conf):
+    """
+    Create the FrameFilter described by conf["filter"], or None if conf has none.
+    """
+    filter_conf = conf.get("filter")
+    if filter_conf is None:
+        return None
+    return FrameFilter(filter_conf)
+
+
+def filter_recording(file_name, filter_conf, tag="EIT"):
+    """
+    Filter the frames of a recording (see virtual_device.load_replay_frames) in one batch.
+
+    Returns
+    -------
+    frames: (n_frames x n_channels) array of filtered frames
+    frame_times: (n_frames,) array of the recorded timestamps, or of seconds from the first frame if it has none
+    """
+    from eit_data_acquisition.virtual_device import load_replay_frames
+
+    frames, frame_times = load_replay_frames(file_name, tag=tag, frame_rate=filter_conf["frame_rate"],
+                                              relative=False)
+    if len(frame_times) > 1 and frame_times[-1] > frame_times[0]:
+        recorded_rate = (len(frame_times) - 1) / (frame_times[-1] - frame_times[0])
+        if abs(recorded_rate - filter_conf["frame_rate"]) > 0.05 * filter_conf["frame_rate"]:
+            print("The filter is designed for {} frames/s, but the recording has {:.1f} frames/s".format(
+                filter_conf["frame_rate"], recorded_rate))
+    return FrameFilter(filter_conf).filter(frames), frame_times
+
+
+class RollingAverage:
+    """
+    Mean of the last n_frames frames, or of the frames of the last seconds seconds, kept with a running sum.
+    """
+    def __init__(self, n_frames=None, seconds=None):
+        if n_frames is None and seconds is None:
+            raise ValueError("A rolling average needs a number of frames or a time window")
+        self.n_frames = n_frames
+        self.seconds = seconds
+        self.frames = deque()
+        self.times = deque()
+        self.sum = None
+        self.n_since_resum = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def add(self, timestamps, frames):
+        """
+        Add an (n_frames x n_channels) array of consecutive frames with their timestamps (in seconds).
+        """
+        if len(frames) == 0:
+            return
+        if self.sum is None or len(self.sum) != frames.shape[1]:
+            self.reset()
+            self.sum = np.zeros(frames.shape[1])
+        self.sum += frames.sum(axis=0)
+        self.frames.extend(frames)
+        self.times.extend(timestamps)
+        while len(self.frames) > 1 and ((self.n_frames is not None and len(self.frames) > self.n_frames) or
+                                        (self.seconds is not None and self.times[-1] - self.times[0] > self.seconds)):
+            self.sum -= self.frames.popleft()
+            self.times.popleft()
+
+        self.n_since_resum += len(frames)
+        if self.n_since_resum >= len(self.frames):
+            self.sum = np.sum(self.frames, axis=0)
+            self.n_since_resum = 0
+
+    def mean(self):
+        """
+        Returns the mean frame, or None if no frame was added.
+        """
+        if len(self.frames) == 0:
+            return None
+        return self.sum / len(self.frames)
+
+    def duration(self):
+        return self.times[-1] - self.times[0] if len(self.times) > 0 else 0
+
+    def reset(self):
+        self.frames.clear()
+        self.times.clear()
+        self.sum = None
+        self.n_since_resum = 0
+
+
+def create_rolling_average(conf):
+    """
+    Create the RollingAverage of conf["background_average"] ({"frames": n} or {"seconds": t}), or None.
+    """
+    average_conf = conf.get("background_average")
+    if average_conf is None:
+        return None
+    return RollingAverage(average_conf.get("frames"), average_conf.get("seconds"))
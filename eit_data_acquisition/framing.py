@@ -0,0 +1,76 @@
+class FrameBuffer:
+    """
+    Splits a stream of bytes read in arbitrary blocks into complete frames.
+
+    Bytes are accumulated in an internal buffer, and every complete frame (ending with termination) is returned as soon
+    as it has been fed, so partial frames left over at the end of a read are completed by the next read instead of being
+    lost. Frames that can't be decoded or don't start with start_char are counted as malformed. Data that grows past
+    max_frame_length without a termination, or is left over when the buffer is closed, is counted as truncated.
+
+    feed_timed also timestamps the frames of a block by when their termination arrived, assuming the block's bytes
+    arrived at an even rate over the interval it was received in.
+    """
+    def __init__(self, termination="\n", start_char=None, encoding="latin-1", max_frame_length=65536):
+        self.termination = termination.encode(encoding) if isinstance(termination, str) else termination
+        self.start_char = start_char
+        self.encoding = encoding
+        self.max_frame_length = max_frame_length
+        self.buffer = bytearray()
+        self.n_frames = 0
+        self.n_malformed = 0
+        self.n_truncated = 0
+
+    def feed(self, data):
+        """
+        Add bytes to the buffer and return the list of complete frames (decoded, without termination) found.
+        """
+        return self.split(data)[0]
+
+    def feed_timed(self, data, start_time, end_time):
+        """
+        Like feed, for data received between start_time and end_time. Returns the frames and their timestamps.
+        """
+        frames, offsets = self.split(data)
+        return frames, [start_time + (end_time - start_time) * offset / len(data) for offset in offsets]
+
+    def split(self, data):
+        """
+        Add bytes to the buffer. Returns the complete frames found, and for each the offset in data just past its
+        termination.
+        """
+        n_buffered = len(self.buffer)
+        self.buffer += data
+        end = self.buffer.rfind(self.termination)
+        if end < 0:
+            if len(self.buffer) > self.max_frame_length:
+                self.n_truncated += 1
+                self.buffer.clear()
+            return [], []
+
+        complete = self.buffer[:end]
+        del self.buffer[:end + len(self.termination)]
+
+        frames = []
+        offsets = []
+        position = 0
+        for raw in complete.split(self.termination):
+            position += len(raw) + len(self.termination)
+            try:
+                frame = raw.decode(self.encoding)
+            except UnicodeDecodeError:
+                self.n_malformed += 1
+                continue
+            if len(frame) == 0 or (self.start_char is not None and frame[0] != self.start_char):
+                self.n_malformed += 1
+                continue
+            frames.append(frame)
+            # A termination split over two reads arrived with the first bytes of data
+            offsets.append(max(position - n_buffered, 0))
+
+        self.n_frames += len(frames)
+        return frames, offsets
+
+    def close(self):
+        if len(self.buffer) > 0:
+            self.n_truncated += 1
+            self.buffer.clear()
@@ -0,0 +1,106 @@
+import numpy as np
+from scipy import sparse
+
+
+class GridInterpolator:
+    """
+    Linear interpolation of mesh node values onto a square pixel grid, as one precomputed sparse matrix.
+
+    Each pixel inside the mesh is a weighted sum of the three nodes of the triangle containing it (barycentric weights),
+    so interpolating a frame is a single sparse matrix-vector product. Pixels outside the mesh are NaN.
+    """
+    def __init__(self, matrix, pixel_index, shape, extent):
+        self.matrix = matrix  # (n_inside_pixels x n_nodes)
+        self.pixel_index = pixel_index  # flat indices of the pixels inside the mesh
+        self.shape = shape
+        self.extent = extent  # (xmin, xmax, ymin, ymax), as used by imshow
+
+    @property
+    def mask(self):
+        mask = np.zeros(self.shape, dtype=bool)
+        mask.flat[self.pixel_index] = True
+        return mask
+
+    def apply(self, values, out=None):
+        """
+        Interpolate node values onto the grid.
+
+        Parameters
+        ----------
+        values: (n_nodes,) array for one frame, or (n_frames x n_nodes) array for many frames at once
+        out: optional preallocated output array, reused between calls to avoid allocating an image per frame
+
+        Returns
+        -------
+        (n, n) image, or (n_frames, n, n) images
+        """
+        values = np.asarray(values)
+        if values.ndim == 1:
+            if out is None:
+                out = np.full(self.shape, np.nan, dtype=np.result_type(values, self.matrix))
+            out.flat[self.pixel_index] = self.matrix @ values
+            return out
+
+        inside = (self.matrix @ values.T).T
+        if out is None:
+            out = np.full((len(values),) + self.shape, np.nan, dtype=inside.dtype)
+        out.reshape(len(values), -1)[:, self.pixel_index] = inside
+        return out
+
+
+def build_grid_interpolator(geometry, resolution=128, margin=0.02):
+    """
+    Build a GridInterpolator for a mesh.
+
+    Parameters
+    ----------
+    geometry: dict with node coordinates "x", "y" and "triangles", as returned by eit.mesh_geometry
+    resolution: number of pixels along each side of the grid
+    margin: fraction of the mesh size left empty around the mesh
+
+    Returns
+    -------
+    GridInterpolator
+    """
+    # Only needed once per mesh, so matplotlib's fast point-in-triangle search is imported here rather than at module
+    # load
+    import matplotlib.tri as tri
+
+    x = np.asarray(geometry["x"], dtype=float)
+    y = np.asarray(geometry["y"], dtype=float)
+    triangles = np.asarray(geometry["triangles"])
+
+    size = max(x.max() - x.min(), y.max() - y.min()) * (1 + 2 * margin)
+    x_center = (x.max() + x.min()) / 2
+    y_center = (y.max() + y.min()) / 2
+    extent = (x_center - size / 2, x_center + size / 2, y_center - size / 2, y_center + size / 2)
+
+    # Pixel centres, row major with row 0 at the bottom (imshow origin="lower")
+    pixel_size = size / resolution
+    xs = extent[0] + pixel_size * (np.arange(resolution) + 0.5)
+    ys = extent[2] + pixel_size * (np.arange(resolution) + 0.5)
+    px, py = np.meshgrid(xs, ys)
+    px = px.ravel()
+    py = py.ravel()
+
+    triangulation = tri.Triangulation(x, y, triangles=triangles)
+    containing = triangulation.get_trifinder()(px, py)
+    pixel_index = np.flatnonzero(containing >= 0)
+    containing = containing[pixel_index]
+
+    # Barycentric coordinates of each inside pixel in its triangle
+    nodes = triangles[containing]
+    x0, y0 = x[nodes[:, 0]], y[nodes[:, 0]]
+    t = np.empty((len(pixel_index), 2, 2))
+    t[:, 0, 0] = x[nodes[:, 1]] - x0
+    t[:, 0, 1] = x[nodes[:, 2]] - x0
+    t[:, 1, 0] = y[nodes[:, 1]] - y0
+    t[:, 1, 1] = y[nodes[:, 2]] - y0
+    rhs = np.stack([px[pixel_index] - x0, py[pixel_index] - y0], axis=1)[:, :, None]
+    l12 = np.linalg.solve(t, rhs)[:, :, 0]
+    weights = np.column_stack([1 - l12.sum(axis=1), l12])
+
+    rows = np.repeat(np.arange(len(pixel_index)), 3)
+    matrix = sparse.csr_matrix((weights.ravel(), (rows, nodes.ravel())), shape=(len(pixel_index), len(x)))
+
+    return GridInterpolator(matrix, pixel_index, (resolution, resolution), extent)
@@ -0,0 +1,230 @@
+"""
+Acquisition, reconstruction and recording without a GUI.
+
+The Reader, EITProcessor and DataSaver workers are wired together with plain callbacks, and a status line is printed
+every status_interval seconds. Several devices can be read at once, each by its own Reader process, in which case a
+FrameMerger aligns their frames by timestamp before they are recorded and reconstructed.
+
+Neither PyQt5 nor matplotlib are imported in the main process. The reconstruction object is set up in the
+EITProcessor's process, so pyeit is only loaded there (and briefly in a helper process that sizes the FrameRing).
+
+With a single device, frames are passed to the consumers through a FrameRing, like in the GUI. Frames the consumers
+lose anyway are counted and reported when the run ends.
+
+    $ python -m eit_data_acquisition headless --device "Virtual EIT" --duration 60 --output-dir data
+    $ python -m eit_data_acquisition headless --device /dev/ttyACM0 /dev/ttyACM1 --output-dir data
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from time import time, sleep
+from eit_data_acquisition.workers import ReaderWorker, EITProcessorWorker, FrameMerger, DataSaver
+from eit_data_acquisition.eit import load_conf, measurement_count
+from eit_data_acquisition.shared_buffers import FrameRing
+from eit_data_acquisition.metrics import PipelineMetrics
+from eit_data_acquisition.cache import file_hash
+
+package_dir = os.path.dirname(os.path.abspath(__file__))
+default_mesh = os.path.join(package_dir, "configuration", "circle_phantom_mesh_no_inclusion.stl")
+default_conf = os.path.join(package_dir, "configuration", "conf.json")
+default_eit_setup = os.path.join(package_dir, "configuration", "eit_setup.json")
+device_configuration = {
+    "baud": 115200,
+    "frame_start_char": "m",
+    "read_timeout": 1,
+    "read_termination_char": "\n",
+    "encoding": "latin-1",
+    "parse_frames": True,
+    "virtual_device": {
+        "mesh": default_mesh,
+        "eit_setup": default_eit_setup,
+        "frame_rate": 50,
+        "rate_multiplier": 1,
+        "noise": 0.01
+    }
+}
+data_saving_configuration = {
+    "directory": "data/",
+    "format": "%Y-%m-%dT%H_%M_eit",
+    "default_suffix": "data",
+    "columns": ["Time", "EIT"],
+    "timestamp_format": "raw",
+    "delimiter": ",",
+    "extension": ".csv",
+    "file_type": "csv",  # "csv" or "binary"
+    "binary_extension": ".eitrec",
+    "flush_interval": 1,
+    "compression": None,  # None or "gzip"
+    "compression_level": 6,  # 1 (fastest) to 9 (smallest)
+    "rotate_size": None,  # If set, start a new segment when the file reaches this many bytes
+    "rotate_duration": None,  # If set, start a new segment after this many seconds
+    "image_extension": ".eitimg"
+}
+merge_configuration = {
+    "tolerance": 0.01,  # Frames of different devices less than this many seconds apart are grouped together
+    "max_delay": 0.5  # Seconds to wait for a device that hasn't sent a frame before leaving it out of a group
+}
+frame_ring_slots = 1024
+status_interval = 1
+stop_timeout = 10
+
+
+def stop_consumer(consumer, timeout=stop_timeout):
+    """
+    Let consumer work through what is left in its queue, then stop it and wait for its process to finish.
+    """
+    deadline = time() + timeout
+    try:
+        while consumer.get_work_queue().qsize() > 0 and time() < deadline:
+            sleep(0.05)
+    except NotImplementedError:
+        # Queue.qsize is not available on macOS
+        sleep(1)
+    consumer.set_stopped()
+    if consumer.process is not None:
+        consumer.process.join(max(0, deadline - time()))
+
+
+def device_tags(device_names):
+    """
+    Tags of the devices: "EIT" for the first device, and "EIT2", "EIT3", ... for the others.
+    """
+    return ["EIT" if i == 0 else "EIT" + str(i + 1) for i in range(len(device_names))]
+
+
+def run_headless(device_names, duration=None, output_directory=None, suffix="", file_type="csv", reconstruct=True,
+                 mesh=default_mesh, eit_setup=default_eit_setup, conf=default_conf, initial_background=None,
+                 lossless=False, n_workers=None, metrics_file=None, recording_options=None, record_images=False):
+    """
+    Read from the devices in device_names until duration seconds have passed (or forever if duration is None) or the
+    process is interrupted.
+
+    Frames are recorded in output_directory if it is given, and reconstructed with the conf file if reconstruct is set.
+    With several devices, all frames go to one file and the first device's frames are reconstructed. recording_options
+    override the data_saving_configuration. A JSON summary of the metrics is appended to metrics_file if it is given.
+
+    Returns the name of the recording, or None if nothing was recorded
+    """
+    metrics = PipelineMetrics()
+    frame_counts = {"frames": 0, "images": 0}
+
+    def on_data(message):
+        frame_counts["frames"] += 1
+        metrics.add(message.get("stage_times"), ("read", "parse"))
+
+    def on_image(result):
+        frame_counts["images"] += 1
+        metrics.add(result[1].get("stage_times"), ("solve", "sim2pts", "ui"))
+
+    def on_stage_times(stage_times):
+        for frame_stage_times in stage_times:
+            metrics.add(frame_stage_times, ("write",))
+
+    def on_merged(group):
+        for message in group["frames"].values():
+            metrics.add(message.get("stage_times"), ("merge",))
+
+    tags = device_tags(device_names)
+    connect_failed = []
+    readers = []
+    for tag in tags:
+        reader = ReaderWorker(tag=tag)
+        reader.on_data = on_data
+        reader.on_connect_failed = lambda tag=tag: connect_failed.append(tag)
+        readers.append(reader)
+
+    frame_ring = None
+    if len(readers) == 1:
+        # pyeit is only loaded in a short-lived process, to keep it out of this one
+        with ProcessPoolExecutor(1) as executor:
+            n_channels = executor.submit(measurement_count, eit_setup).result()
+        frame_ring = FrameRing(frame_ring_slots, n_channels, tag=tags[0])
+
+    configuration = {**data_saving_configuration, "directory": os.path.join(output_directory or ".", ""),
+                     "file_type": file_type, "columns": ["Time"] + tags, **(recording_options or {})}
+    consumers = {}
+    if reconstruct:
+        processor = EITProcessorWorker(None, lossless=lossless, n_workers=n_workers)
+        processor.on_image = on_image
+        processor.start_new(work_kwargs={"mesh": mesh, "eit_setup": eit_setup, "configuration": conf,
+                                         "initial_bg": initial_background, "tag": tags[0], "frame_ring": frame_ring,
+                                         "recording_configuration": configuration})
+        consumers["processor"] = processor
+
+    data_saver = None
+    if output_directory is not None:
+        data_saver = DataSaver()
+        data_saver.on_stage_times = on_stage_times
+        if record_images and reconstruct:
+            data_saver.on_recording_started = processor.start_image_recording
+        metadata = {"mesh": mesh, "mesh_sha256": file_hash(mesh), "eit_setup": load_conf(eit_setup),
+                    "device": device_configuration, "devices": dict(zip(tags, device_names))}
+        data_saver.start_new(work_kwargs={"suffix": suffix, "configuration": configuration, "metadata": metadata,
+                                          "frame_ring": frame_ring})
+        consumers["saver"] = data_saver
+
+    subscribers = [consumer.get_work_queue() for consumer in consumers.values()]
+    merger = None
+    if len(readers) > 1:
+        merger = FrameMerger(tags, **merge_configuration)
+        merger.on_data = on_merged
+        merger.set_subscribers(subscribers)
+        merger.start_new()
+        # The merger is stopped first, so that it can hand what it still holds to the other consumers
+        consumers = {"merger": merger, **consumers}
+        subscribers = [merger.get_work_queue()]
+    for reader, device_name in zip(readers, device_names):
+        reader.set_subscribers(subscribers)
+        reader.start_new(work_kwargs={"device_name": device_name, "configuration": device_configuration,
+                                      "frame_ring": frame_ring})
+
+    start_time = time()
+    try:
+        while not connect_failed and all(reader.get_state() != ReaderWorker.stopped for reader in readers):
+            if duration is not None and time() - start_time >= duration:
+                break
+            sleep(status_interval if duration is None else min(status_interval, duration - (time() - start_time)))
+            for name, consumer in consumers.items():
+                try:
+                    metrics.set_queue_depth(name, consumer.get_work_queue().qsize())
+                except NotImplementedError:
+                    pass
+            summary = metrics.summary()
+            if metrics_file is not None:
+                metrics.export(metrics_file, summary)
+            stages = summary["stages"]
+            print("{:.0f} s: {} frames ({:.1f} fps), {} images ({:.1f} fps)".format(
+                time() - start_time, frame_counts["frames"], stages.get("parse", {}).get("fps", 0),
+                frame_counts["images"], stages.get("ui", {}).get("fps", 0)))
+    except KeyboardInterrupt:
+        pass
+
+    for reader in readers:
+        reader.set_stopped()
+    for reader in readers:
+        if reader.process is not None:
+            reader.process.join(stop_timeout)
+    for consumer in consumers.values():
+        stop_consumer(consumer)
+    for reader in readers:
+        if reader.process is not None and reader.process.is_alive():
+            # A reader can't exit while frames it queued for a consumer that stopped before taking them are still
+            # buffered, and those frames are dropped anyway
+            reader.process.terminate()
+
+    errors = [reader.get_frame_errors() for reader in readers]
+    print("Stopped after {:.1f} s: {} frames ({} malformed, {} truncated), {} images".format(
+        time() - start_time, frame_counts["frames"], sum(error["malformed"] for error in errors),
+        sum(error["truncated"] for error in errors), frame_counts["images"]))
+    dropped = {"merger": 0 if merger is None else merger.get_dropped(),
+               "processor": consumers["processor"].get_dropped() if reconstruct else 0,
+               "recording": 0 if data_saver is None else data_saver.get_dropped()}
+    if any(n_dropped > 0 for n_dropped in dropped.values()):
+        print("Dropped because a consumer fell behind: {} merged groups, {} frames missed by the processor, {} "
+              "frames not recorded".format(dropped["merger"], dropped["processor"], dropped["recording"]))
+    for tag in connect_failed:
+        print("Could not connect to " + device_names[tags.index(tag)])
+    if data_saver is None:
+        return None
+    print("Recorded to " + str(data_saver.get_filename()))
+    return data_saver.get_filename()
@@ -1,20 +1,22 @@
 import sys
-from PyQt5 import QtWidgets, uic
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_qt5agg import (
-    FigureCanvasQTAgg as FigureCanvas,
-    NavigationToolbar2QT as NavigationToolbar
-)
-import matplotlib
-import matplotlib.pyplot
-import time
-from eit_data_acquisition.background_process_workers import *
+from time import time, perf_counter
+# Taken before the other imports, so that the startup report includes them
+startup_start = perf_counter()
+import threading
+from PyQt5 import QtWidgets, QtCore, uic
+from eit_data_acquisition.background_process_workers import Reader, EITProcessor, DataSaver, item_text
 from eit_data_acquisition.Toaster import Toaster
+from eit_data_acquisition.console import RawDataConsole
 from PyQt5.QtGui import QIcon
-from pyeit.visual.plot import create_plot
-from eit_data_acquisition.eit import setup_eit
+from eit_data_acquisition.eit import setup_eit, mesh_geometry, load_conf, format_oeit_line
+from eit_data_acquisition.shared_buffers import FrameRing
+from eit_data_acquisition.metrics import PipelineMetrics, StartupReport, stamp
+from eit_data_acquisition.cache import file_hash
 import multiprocessing
 
+# matplotlib, the plotting module and pyeit are imported when first needed: pyeit (which also loads matplotlib) by the EIT
+# setup, which runs in the background once the window is shown, and the plotting modules when the first image arrives
+
 Ui_MainWindow, QMainWindow = uic.loadUiType("layout/layout.ui")
 
 default_mesh = "configuration/circle_phantom_mesh_no_inclusion.stl"
@@ -25,7 +27,17 @@ device_configuration = {
     "frame_start_char": "m",
     "read_timeout": 10000,
     "read_termination_char": "\n",
-    "encoding": "latin-1"
+    "encoding": "latin-1",
+    "parse_frames": True,
+    # Settings of the "Virtual EIT" and "Replay: <file>" devices, which simulate or replay frames without hardware
+    "virtual_device": {
+        "mesh": default_mesh,
+        "eit_setup": default_eit_setup,
+        "frame_rate": 50,
+        "rate_multiplier": 1,
+        "noise": 0.01,
+        "replay_files": []
+    }
 }
 data_saving_configuration = {
     "directory": "data/",
@@ -35,50 +47,209 @@ data_saving_configuration = {
     "timestamp_format": "raw",
     "delimiter": ",",
     "extension": ".csv",
+    "file_type": "csv",  # "csv" or "binary"
+    "binary_extension": ".eitrec",
+    "flush_interval": 1,
+    "compression": None,  # None or "gzip"
+    "compression_level": 6,  # 1 (fastest) to 9 (smallest)
+    "rotate_size": None,  # If set, start a new segment when the file reaches this many bytes
+    "rotate_duration": None,  # If set, start a new segment after this many seconds
+    "record_images": False,  # Also record the reconstructed images while recording
+    "image_extension": ".eitimg",
     "buffer_size": 1000,
     "buffer_timeout": .5
 }
+frame_ring_slots = 1024
+processing_configuration = {
+    # Reconstruct every frame in a pool of worker processes instead of only the newest one
+    "lossless": False,
+    "n_workers": None,  # Defaults to the number of CPUs
+    "max_pending": None,  # Frames in flight before the processor waits for the pool. Defaults to 2 * n_workers
+    "background_timeout": 2  # Seconds Set Background waits for a frame
+}
+console_configuration = {
+    "max_lines": 500,
+    "max_rate": 10  # widget updates per second
+}
+display_configuration = {
+    "color_scale": "decay",  # "auto", "fixed" or "decay"
+    "fixed_scale": (-1, 1),
+    "scale_decay": 0.98,
+    "redraw_tolerance": 0.05,
+    "shading": "flat",
+    "mode": "mesh",  # "mesh" (tripcolor) or "grid" (interpolated image)
+    "grid_resolution": 128,
+    "max_fps": 30
+}
+waveform_configuration = {
+    "show": True,  # Plot the global impedance waveform under the image (only for the "solve" reconstruction). Makes
+    # the EIT processor summarize every frame
+    "series": None,  # Summaries to plot (see summaries), all but "delta_v" if None
+    "seconds": 20,
+    "n_points": 5000,  # Frames kept, at least seconds times the frame rate
+    "redraw_tolerance": 0.05,
+    "max_fps": 30,
+    "height": 200
+}
+metrics_configuration = {
+    "window": 1000,  # Number of frames per stage the latency percentiles are computed over
+    "interval": 1,  # Seconds between overlay updates and exports
+    "show_overlay": False,
+    "export_file": None,  # If set, a JSON summary is appended to this file every interval
+    "print_startup_report": True
+}
 spectra_data_format = {
     "prefix": "magnitudes:        ",
     "separator": ",       "
 }
 
 class MainWindow(QMainWindow, Ui_MainWindow):
+    eit_ready = QtCore.pyqtSignal(object, float)
+
     def __init__(self):
+        self.startup_report = StartupReport(startup_start)
+        self.startup_report.mark("imports")
         super(MainWindow, self).__init__()
         self.first_plot = True
         self.setupUi(self)
         self.canvas = None
         self.plot_axes = None
+        self.geometry = None
+        self.eit_renderer = None
+        self.pending_eit_image = None
+        self.last_eit_draw = 0
+        self.waveform = None
+        self.waveform_canvas = None
         self.populate_devices()
+        # The EIT object, frame ring and processor are created once the EIT setup, started by start_eit_setup, is done
+        self.eit_obj = None
+        self.frame_ring = None
+        self.eit_processor = None
         self.eit_reader = Reader(tag="EIT")
-        self.eit_processor = EITProcessor()
         self.data_saver = DataSaver()
         self.conf = default_conf
         self.eit_setup = default_eit_setup
         self.initial_background = None
-        self.color_axis = None
-        self.eit_scale = (np.inf, np.NINF)  # ymin, ymax
+        self.recording = False
 
         self.comboBox.currentTextChanged.connect(self.change_eit_device)
         self.startRecordingButton.clicked.connect(
             lambda: self.start_recording(self.dataFileSuffixTextEdit.text()))
         self.stopRecordingButton.clicked.connect(self.stop_recording)
 
-        self.eit_obj = self.initialize_eit_obj(default_mesh, self.eit_setup)
-        self.eit_reader.new_data.connect(
-            lambda result: (self.textEdit.append(result["data"])))
-        self.eit_reader.set_subscribers([self.eit_processor.get_work_queue(), self.data_saver.get_work_queue()])
+        self.console = RawDataConsole(self.textEdit, console_configuration["max_lines"],
+                                      console_configuration["max_rate"], formatter=self.raw_data_text, parent=self)
+        self.pauseConsoleCheckBox.toggled.connect(self.console.set_paused)
+        self.eit_reader.new_data.connect(self.console.append)
+        self.eit_reader.new_data.connect(lambda message: self.metrics.add(message.get("stage_times"), ("read", "parse")))
         self.eit_reader.on_connect_failed = self.eit_connect_failed
 
+        self.eit_ready.connect(self.set_eit_obj)
+
         self.set_background_button.clicked.connect(self.set_background)
         self.clear_background_button.clicked.connect(lambda: self.eit_processor.set_background(None))
 
+        self.metrics = PipelineMetrics(metrics_configuration["window"])
+        self.metrics_label = None
+        self.data_saver.on_stage_times = self.add_write_stage_times
+        self.data_saver.on_recording_started = self.start_image_recording
+        self.showMetricsCheckBox.setChecked(metrics_configuration["show_overlay"])
+        self.showMetricsCheckBox.toggled.connect(self.update_metrics)
+        self.metrics_timer = QtCore.QTimer(self)
+        self.metrics_timer.setInterval(int(metrics_configuration["interval"] * 1000))
+        self.metrics_timer.timeout.connect(self.update_metrics)
+        self.metrics_timer.start()
+        # Summaries arrive with every frame, but the waveform is only drawn at max_fps
+        self.waveform_timer = QtCore.QTimer(self)
+        self.waveform_timer.setInterval(int(1000 / waveform_configuration["max_fps"]))
+        self.waveform_timer.timeout.connect(self.draw_waveform)
+        self.waveform_timer.start()
+
         self.start_time = time()
         self.update_ui_state()
+        self.startup_report.mark("main window")
+
+    def start_eit_setup(self):
+        """
+        Set up the EIT object in a background thread, so the window can be shown in the meantime. Devices can be
+        selected once it is done.
+        """
+        self.comboBox.setEnabled(False)
+        self.comboBox.setToolTip("Setting up EIT...")
+        threading.Thread(target=self.run_eit_setup, args=(default_mesh, default_eit_setup), daemon=True).start()
+
+    def run_eit_setup(self, mesh, eit_setup):
+        start = perf_counter()
+        try:
+            eit_obj = self.initialize_eit_obj(mesh, eit_setup)
+        except Exception as e:
+            print(e)
+            eit_obj = None
+        # Signals emitted from another thread are delivered in the GUI thread
+        self.eit_ready.emit(eit_obj, perf_counter() - start)
+
+    def set_eit_obj(self, eit_obj, setup_time):
+        self.startup_report.add("EIT setup (background)", setup_time)
+        if metrics_configuration["print_startup_report"]:
+            print(self.startup_report.format())
+        if eit_obj is None:
+            Toaster.showMessage(self, "EIT setup failed")
+            return
+
+        self.eit_obj = eit_obj
+        # Frames are passed from the reader to the processor and data saver through shared memory
+        self.frame_ring = FrameRing(frame_ring_slots, self.eit_obj.fwd.protocol.n_meas_tot, tag="EIT")
+        self.eit_processor = EITProcessor(self.eit_obj.fwd.protocol.n_meas_tot, **processing_configuration)
+        self.eit_reader.set_subscribers([self.eit_processor.get_work_queue(), self.data_saver.get_work_queue()])
+        self.eit_processor.new_data.connect(lambda data: self.update_eit_plot(data[0], data[1]))
+        self.eit_processor.new_geometry.connect(self.set_geometry)
+        self.eit_processor.new_summaries.connect(self.add_summaries)
+        self.eit_processor.background_set.connect(self.save_background)
+        self.comboBox.setToolTip("")
+        self.comboBox.setEnabled(True)
+
+    def raw_data_text(self, result):
+        if "data" not in result:
+            frame = self.frame_ring.read(result["sequence"])
+            if frame is None:
+                # Already overwritten in the ring
+                return None
+            result = {**result, "data": frame[0]}
+        return item_text(result)
+
+    def add_write_stage_times(self, stage_times):
+        for frame_stage_times in stage_times:
+            self.metrics.add(frame_stage_times, ("write",))
+
+    def update_metrics(self):
+        for name, worker in (("processor", self.eit_processor), ("saver", self.data_saver)):
+            if worker is None:
+                continue
+            try:
+                self.metrics.set_queue_depth(name, worker.get_work_queue().qsize())
+            except NotImplementedError:
+                # Queue.qsize is not available on macOS
+                pass
+
+        summary = self.metrics.summary()
+        if metrics_configuration["export_file"] is not None:
+            self.metrics.export(metrics_configuration["export_file"], summary)
+        if self.metrics_label is not None:
+            self.metrics_label.setVisible(self.showMetricsCheckBox.isChecked())
+            if self.showMetricsCheckBox.isChecked():
+                self.metrics_label.setText(self.metrics.format_summary(summary))
+                self.metrics_label.adjustSize()
+
+    def set_geometry(self, geometry):
+        self.geometry = geometry
+        if self.eit_renderer is not None:
+            # The mesh changed, so the plot artists need to be rebuilt
+            self.eit_renderer.remove()
+            self.eit_renderer = self.create_eit_renderer()
 
     def reset_eit_scale(self):
-        self.eit_scale = (np.inf, np.NINF)
+        if self.eit_renderer is not None:
+            self.eit_renderer.reset_scale()
 
     def eit_connect_failed(self):
         print("EIT reader connect failed")
@@ -102,20 +273,40 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             self.startRecordingButton.setEnabled(False)
 
     def set_background(self):
-        current_frame = self.eit_processor.get_current_frame()
-        if current_frame is not None:
-            self.eit_processor.set_background(current_frame)
-            background_file = DataSaver.create_unique_save_file("background", data_saving_configuration)
-            background_file.write(spectra_data_format["prefix"] + "".join(
-                ("{}" + spectra_data_format["separator"]).format(item) for item in current_frame))
-            background_file.close()
-            Toaster.showMessage(self, "Background frame saved in: " + background_file.name)
+        # The processor sets the background (the mean of the latest frames if the configuration has a
+        # "background_average") on its next frame, and then emits background_set
+        self.eit_processor.request_background()
+        QtCore.QTimer.singleShot(int(processing_configuration["background_timeout"] * 1000),
+                                 self.check_background_request)
+
+    def check_background_request(self):
+        if self.eit_processor.cancel_background_request():
+            Toaster.showMessage(self, "No frames received, the background was not set")
+
+    def save_background(self, background_set):
+        background = self.eit_processor.get_background()
+        if background is None:
+            return
+        background_file = DataSaver.create_unique_save_file("background", data_saving_configuration)
+        background_file.write(format_oeit_line(background, spectra_data_format["prefix"],
+                                               spectra_data_format["separator"]))
+        background_file.close()
+        if background_set["n_frames"] > 1:
+            message = "Background averaged over {} frames ({:.1f} s) saved in: ".format(background_set["n_frames"],
+                                                                                        background_set["seconds"])
+        else:
+            message = "Background frame saved in: "
+        Toaster.showMessage(self, message + background_file.name)
 
     def start_recording(self, suffix):
         self.stopRecordingButton.setVisible(True)
         self.startRecordingButton.setVisible(False)
 
-        self.data_saver.start_new(work_kwargs={"suffix": suffix, "configuration": data_saving_configuration})
+        metadata = {"mesh": default_mesh, "mesh_sha256": file_hash(default_mesh), "eit_setup": load_conf(self.eit_setup),
+                    "device": device_configuration}
+        self.data_saver.start_new(work_kwargs={"suffix": suffix, "configuration": data_saving_configuration,
+                                               "metadata": metadata, "frame_ring": self.frame_ring})
+        self.recording = True
 
         self.comboBox.setEnabled(False)
         self.dataFileSuffixTextEdit.setEnabled(False)
@@ -130,10 +321,17 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.comboBox.setEnabled(True)
         self.dataFileSuffixTextEdit.setEnabled(True)
 
+        self.recording = False
         self.data_saver.set_stop_at_queue_end()
+        self.eit_processor.stop_image_recording()
 
         Toaster.showMessage(self, "Stopped recording")
 
+    def start_image_recording(self, recording_name):
+        # Called once the data saver has created the recording, so the images are named after it
+        if data_saving_configuration["record_images"] and self.recording:
+            self.eit_processor.start_image_recording(recording_name)
+
     # This should be in EITProcessor
     @staticmethod
     def initialize_eit_obj(eit_mesh, conf):
@@ -141,36 +339,88 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         return eit_obj
 
     def add_eit_plot(self):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_qt5agg import (
+            FigureCanvasQTAgg as FigureCanvas,
+            NavigationToolbar2QT as NavigationToolbar
+        )
+
         self.placeholderWidget.setVisible(False)
 
-        self.canvas = FigureCanvas(matplotlib.figure.Figure())
-        self.plot_axes = self.canvas.figure.subplots()
+        self.canvas = FigureCanvas(Figure())
         toolbar = NavigationToolbar(self.canvas, self.canvas, coordinates=True)
 
-        self.verticalLayout_5.addWidget(self.canvas)
-        self.verticalLayout_5.addWidget(toolbar)
-
-
-    def update_eit_plot(self, eit_image, pyeit_obj):
+        # In place of the placeholder, above the waveform if that is already shown
+        index = self.verticalLayout_5.indexOf(self.placeholderWidget)
+        self.verticalLayout_5.insertWidget(index + 1, self.canvas)
+        self.verticalLayout_5.insertWidget(index + 2, toolbar)
+
+        self.eit_renderer = self.create_eit_renderer()
+        self.plot_axes = self.eit_renderer.ax
+
+        # Metrics overlay in the corner of the plot
+        self.metrics_label = QtWidgets.QLabel(self.canvas)
+        self.metrics_label.setStyleSheet("background-color: rgba(255, 255, 255, 200); font-family: monospace;")
+        self.metrics_label.move(5, 5)
+        self.metrics_label.setVisible(False)
+
+    def create_eit_renderer(self):
+        from eit_data_acquisition.plotting import EITImageRenderer
+
+        if self.geometry is None:
+            self.geometry = mesh_geometry(self.eit_obj)
+        kwargs = {key: value for key, value in display_configuration.items() if key != "max_fps"}
+        return EITImageRenderer(self.canvas.figure, self.geometry, **kwargs)
+
+    def update_eit_plot(self, eit_image, frame_info=None):
+        stage_times = None if frame_info is None else frame_info.get("stage_times")
+        self.metrics.add(stage_times, ("solve", "sim2pts", "ui"))
+        # Only the newest image is drawn. Images arriving while a draw is pending replace the pending one, so the plot
+        # drops stale frames instead of queueing them when drawing falls behind
+        if self.pending_eit_image is None:
+            wait = 1 / display_configuration["max_fps"] - (time() - self.last_eit_draw)
+            QtCore.QTimer.singleShot(max(0, int(wait * 1000)), self.draw_eit_plot)
+        self.pending_eit_image = (eit_image, stage_times)
+
+    def draw_eit_plot(self):
+        pending, self.pending_eit_image = self.pending_eit_image, None
+        if pending is None:
+            return
+        eit_image, stage_times = pending
         if self.first_plot:
             self.add_eit_plot()
             self.first_plot = False
 
-        # Removing all axes since create_plot creates a colorbar, which creates its own axes
-        for ax in self.canvas.figure.axes:
-            ax.remove()
-        ax = self.canvas.figure.subplots()
+        self.last_eit_draw = time()
+        self.eit_renderer.update(eit_image)
+        self.metrics.add(stamp(stage_times, "draw"), ("draw",))
+
+    def add_summaries(self, summaries):
+        if self.waveform is None:
+            if not waveform_configuration["show"]:
+                return
+            self.add_waveform_plot(summaries["names"])
+        self.waveform.add(summaries["timestamp"], summaries["values"])
+
+    def add_waveform_plot(self, names):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+        from eit_data_acquisition.plotting import WaveformPlot
 
-        vmin = min(eit_image)
-        vmax = max(eit_image)
+        self.waveform_canvas = FigureCanvas(Figure(tight_layout=True))
+        self.waveform_canvas.setFixedHeight(waveform_configuration["height"])
+        self.verticalLayout_5.addWidget(self.waveform_canvas)
+        self.waveform = WaveformPlot(self.waveform_canvas.figure, names, waveform_configuration["series"],
+                                     waveform_configuration["seconds"], waveform_configuration["n_points"],
+                                     waveform_configuration["redraw_tolerance"])
 
-        img, text, _ = create_plot(ax, eit_image,  pyeit_obj.mesh, vmax=vmax, vmin=vmin)
-        self.canvas.draw_idle()
-        return img, text
+    def draw_waveform(self):
+        if self.waveform is not None:
+            self.waveform.draw()
 
     def populate_devices(self):
         self.comboBox.addItems(["None"])
-        self.comboBox.addItems(Reader.list_devices())
+        self.comboBox.addItems(Reader.list_devices(device_configuration["virtual_device"]["replay_files"]))
         self.comboBox.setCurrentIndex(0)
 
     def change_eit_device(self, text):
@@ -182,12 +432,15 @@ class MainWindow(QMainWindow, Ui_MainWindow):
                 self.eit_reader.set_stopped()
                 self.update_ui_state()
                 return
-        self.eit_processor.start_new(work_kwargs={"eit_obj": self.eit_obj, "configuration": self.conf, "initial_bg": self.initial_background})
-        self.eit_processor.new_data.connect(lambda data: self.update_eit_plot(data[1], self.eit_obj))
+        self.eit_processor.start_new(work_kwargs={"eit_obj": self.eit_obj, "configuration": self.conf,
+                                                  "initial_bg": self.initial_background, "frame_ring": self.frame_ring,
+                                                  "recording_configuration": data_saving_configuration,
+                                                  "summaries": waveform_configuration["show"]})
         self.set_background_button.setEnabled(True)
         self.clear_background_button.setEnabled(True)
 
-        self.eit_reader.start_new(work_kwargs={"device_name": text, "configuration": device_configuration})
+        self.eit_reader.start_new(work_kwargs={"device_name": text, "configuration": device_configuration,
+                                               "frame_ring": self.frame_ring})
 
         self.update_ui_state()
 
@@ -205,4 +458,6 @@ if __name__ == '__main__':
     main_window.resize(dw.availableGeometry(dw).size() * 0.7)
 
     main_window.show()
+    main_window.startup_report.mark("window shown")
+    main_window.start_eit_setup()
     app.exec()
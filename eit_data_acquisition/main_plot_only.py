@@ -39,9 +39,11 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.setupUi(self)
         self.canvas = None
         self.plot_axes = None
+        self.geometry = None
         self.populate_devices()
+        self.eit_obj = self.initialize_eit_obj(default_mesh, default_eit_setup)
         self.eit_reader = Reader(tag="EIT")
-        self.eit_processor = EITProcessor()
+        self.eit_processor = EITProcessor(self.eit_obj.fwd.protocol.n_meas_tot)
         self.conf = default_conf
         self.eit_setup = default_eit_setup
         self.initial_background = None
@@ -50,16 +52,21 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
         self.comboBox.currentTextChanged.connect(self.change_eit_device)
 
-        self.eit_obj = self.initialize_eit_obj(default_mesh, self.eit_setup)
         self.eit_reader.set_subscribers([self.eit_processor.get_work_queue()])
         self.eit_reader.on_connect_failed = self.eit_connect_failed
 
+        self.eit_processor.new_data.connect(lambda data: self.update_eit_plot(data[0], self.eit_obj))
+        self.eit_processor.new_geometry.connect(self.set_geometry)
+
         self.set_background_button.clicked.connect(self.set_background)
         self.clear_background_button.clicked.connect(lambda: self.eit_processor.set_background(None))
 
         self.start_time = time()
         self.update_ui_state()
 
+    def set_geometry(self, geometry):
+        self.geometry = geometry
+
     def reset_eit_scale(self):
         self.eit_scale = (np.inf, np.NINF)
 
@@ -131,7 +138,6 @@ class MainWindow(QMainWindow, Ui_MainWindow):
                 self.update_ui_state()
                 return
         self.eit_processor.start_new(work_kwargs={"eit_obj": self.eit_obj, "configuration": self.conf, "initial_bg": self.initial_background})
-        self.eit_processor.new_data.connect(lambda data: self.update_eit_plot(data[1], self.eit_obj))
         self.set_background_button.setEnabled(True)
         self.clear_background_button.setEnabled(True)
 
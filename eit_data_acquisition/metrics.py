@@ -0,0 +1,146 @@
+"""
+Per-frame pipeline timing.
+
+Each Reader message carries a "stage_times" dict of time.perf_counter_ns() timestamps, to which every stage that handles
+the frame adds its own:
+
+    read: the block containing the frame was read from the device
+    parse: the frame was parsed (Reader)
+    merge: the frame was grouped with the other devices' frames (FrameMerger, when reading several devices)
+    solve: the reconstruction was solved (EITProcessor)
+    sim2pts: the element values were interpolated to the nodes (EITProcessor)
+    ui: the image reached the GUI process
+    draw: the image was drawn
+    write: the frame was written to the recording (DataSaver)
+
+perf_counter is a system wide monotonic clock on Linux and Windows, so timestamps taken in different worker processes
+can be compared. PipelineMetrics aggregates the timestamps into rolling latency percentiles and rates per stage.
+"""
+
+import json
+import threading
+from collections import deque
+from time import perf_counter, perf_counter_ns, time
+import numpy as np
+
+pipeline_stages = ["read", "parse", "merge", "solve", "sim2pts", "ui", "draw", "write"]
+
+
+def stamp(stage_times, stage):
+    if stage_times is not None:
+        stage_times[stage] = perf_counter_ns()
+    return stage_times
+
+
+class StartupReport:
+    """
+    Durations of the steps of starting the app. mark(step) ends a step started at the previous mark (or at start),
+    add(step, seconds) records a step timed elsewhere, e.g. one run in the background.
+    """
+    def __init__(self, start=None):
+        self.start = perf_counter() if start is None else start
+        self.last = self.start
+        self.steps = []
+
+    def mark(self, step):
+        now = perf_counter()
+        self.steps.append((step, now - self.last))
+        self.last = now
+
+    def add(self, step, seconds):
+        self.steps.append((step, seconds))
+
+    def format(self):
+        lines = ["Startup times:"]
+        lines += ["  {:30s}{:7.2f} s".format(step, seconds) for step, seconds in self.steps]
+        lines.append("  {:30s}{:7.2f} s".format("until now", perf_counter() - self.start))
+        return "\n".join(lines)
+
+
+class PipelineMetrics:
+    """
+    Rolling statistics of the stage timestamps of the last window frames to reach each stage.
+
+    For each stage, the latency is the time from the frame being read to it reaching the stage, and the rate is the
+    number of frames reaching the stage per second over the last rate_window seconds. Queue depths are set from outside
+    with set_queue_depth. Frames can be added from any thread.
+    """
+    def __init__(self, window=1000, rate_window=1.0):
+        self.window = window
+        self.rate_window = rate_window
+        self.times = {}
+        self.latencies = {}
+        self.queue_depths = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage_times, stages=None):
+        """
+        Record the timestamps of one frame. If stages is given, only those stages are recorded (the others are recorded
+        by whoever handled them), but latencies are still measured from the frame's read time.
+        """
+        if not stage_times:
+            return
+        read_time = stage_times.get("read")
+        with self.lock:
+            for stage, stage_time in stage_times.items():
+                if stages is not None and stage not in stages:
+                    continue
+                if stage not in self.times:
+                    self.times[stage] = deque(maxlen=self.window)
+                    self.latencies[stage] = deque(maxlen=self.window)
+                self.times[stage].append(stage_time)
+                if read_time is not None:
+                    self.latencies[stage].append((stage_time - read_time) / 1e6)
+
+    def set_queue_depth(self, name, depth):
+        self.queue_depths[name] = depth
+
+    def summary(self):
+        """
+        Returns a dict with, for each stage seen so far, its "fps" and the "p50", "p90", "p99" and "max" latency in ms,
+        and the current queue depths.
+        """
+        now = perf_counter_ns()
+        with self.lock:
+            samples = {stage: (np.array(self.times[stage]), np.array(self.latencies[stage])) for stage in self.times}
+
+        stages = {}
+        order = [stage for stage in pipeline_stages if stage in samples]
+        order += [stage for stage in samples if stage not in pipeline_stages]
+        for stage in order:
+            times, latencies = samples[stage]
+            recent = times[times > now - self.rate_window * 1e9]
+            if len(recent) == self.window and recent[-1] > recent[0]:
+                # The window holds less than rate_window seconds of frames
+                fps = (len(recent) - 1) / ((recent[-1] - recent[0]) / 1e9)
+            else:
+                fps = len(recent) / self.rate_window
+            stats = {"fps": fps}
+            if len(latencies) > 0:
+                p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+                stats.update({"p50": p50, "p90": p90, "p99": p99, "max": float(np.max(latencies))})
+            stages[stage] = stats
+
+        return {"time": time(), "stages": stages, "queues": dict(self.queue_depths)}
+
+    def format_summary(self, summary=None):
+        if summary is None:
+            summary = self.summary()
+        lines = ["{:8s}{:>8s}{:>9s}{:>9s}{:>9s}".format("stage", "fps", "p50 ms", "p90 ms", "p99 ms")]
+        for stage, stats in summary["stages"].items():
+            line = "{:8s}{:8.1f}".format(stage, stats["fps"])
+            if "p50" in stats:
+                line += "{:9.1f}{:9.1f}{:9.1f}".format(stats["p50"], stats["p90"], stats["p99"])
+            lines.append(line)
+        for name, depth in summary["queues"].items():
+            lines.append("{} queue: {}".format(name, depth))
+        return "\n".join(lines)
+
+    def export(self, file_name, summary=None):
+        """
+        Append a summary to file_name as one line of JSON.
+        """
+        if summary is None:
+            summary = self.summary()
+        with open(file_name, "a") as f:
+            f.write(json.dumps(summary) + "\n")
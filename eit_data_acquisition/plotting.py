@@ -0,0 +1,226 @@
+import numpy as np
+import matplotlib.tri as tri
+from eit_data_acquisition.grid_interpolation import build_grid_interpolator
+
+
+class EITImageRenderer:
+    """
+    Draws EIT images into a matplotlib figure, creating the tripcolor, colorbar and electrode artists only once.
+
+    Each update only sets the image data (and the colour limits when they change enough to matter). When the colour
+    limits are unchanged the image is blitted onto a cached copy of the axes background instead of redrawing the whole
+    figure, so the colorbar and axes are only redrawn when the colour scale actually changes.
+
+    Colour scale modes:
+        "auto": limits follow each image's min and max
+        "fixed": limits are fixed_scale
+        "decay": limits expand immediately to include each image, and shrink back towards the image's range by
+                 (1 - scale_decay) per frame
+    In auto and decay mode the limits are only changed when they move by more than redraw_tolerance times the current
+    range, so small fluctuations don't cost a full redraw.
+
+    Display modes:
+        "mesh": tripcolor of the mesh (with flat or gouraud shading)
+        "grid": imshow of the image interpolated onto a grid_resolution x grid_resolution pixel grid with a
+                precomputed sparse interpolation matrix (see grid_interpolation). Much cheaper to draw for fine meshes.
+    """
+    def __init__(self, figure, geometry, color_scale="auto", fixed_scale=None, scale_decay=0.98,
+                 redraw_tolerance=0.05, shading="flat", mode="mesh", grid_resolution=128, title="EIT Plot"):
+        self.figure = figure
+        self.canvas = figure.canvas
+        self.color_scale = color_scale
+        self.fixed_scale = fixed_scale
+        self.scale_decay = scale_decay
+        self.redraw_tolerance = redraw_tolerance
+        self.shading = shading
+        self.mode = mode
+        self.triangles = np.asarray(geometry["triangles"])
+        self.scale = None
+        self.target_scale = None
+
+        self.ax = figure.subplots()
+        if mode == "grid":
+            self.grid_interpolator = build_grid_interpolator(geometry, grid_resolution)
+            self.grid_image = self.grid_interpolator.apply(np.zeros(len(geometry["x"])))
+            self.image = self.ax.imshow(self.grid_image, origin="lower", extent=self.grid_interpolator.extent,
+                                        interpolation="nearest", animated=True)
+        else:
+            triangulation = tri.Triangulation(geometry["x"], geometry["y"], triangles=self.triangles)
+            self.image = self.ax.tripcolor(triangulation, np.zeros(len(geometry["x"])), shading=shading,
+                                           animated=True)
+        if color_scale == "fixed":
+            self.set_scale(fixed_scale)
+        self.colorbar = figure.colorbar(self.image, ax=self.ax)
+
+        electrode_points = np.asarray(geometry["electrode_points"])
+        self.electrodes, = self.ax.plot(electrode_points[:, 0], electrode_points[:, 1], "o", color="black",
+                                        markersize=3, animated=True)
+        self.ax.set_aspect("equal")
+        self.ax.set_xticks([])
+        self.ax.set_yticks([])
+        self.ax.set_title(title)
+
+        self.blit_background = None
+        self.draw_event_id = self.canvas.mpl_connect("draw_event", self.on_draw)
+
+    def on_draw(self, event):
+        # A full draw skips the animated artists. Cache the axes without them for blitting, then draw them on top
+        self.blit_background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.draw_animated()
+
+    def draw_animated(self):
+        self.ax.draw_artist(self.image)
+        self.ax.draw_artist(self.electrodes)
+
+    def update(self, eit_image):
+        if self.mode == "grid":
+            self.image.set_data(self.grid_interpolator.apply(eit_image, out=self.grid_image))
+        elif self.shading == "flat":
+            # Flat shading colours each triangle with the mean of its node values
+            self.image.set_array(eit_image[self.triangles].mean(axis=1))
+        else:
+            self.image.set_array(eit_image)
+
+        if self.update_scale(eit_image) or self.blit_background is None:
+            self.canvas.draw_idle()
+        else:
+            self.canvas.restore_region(self.blit_background)
+            self.draw_animated()
+            self.canvas.blit(self.ax.bbox)
+
+    def set_scale(self, scale):
+        self.scale = (float(scale[0]), float(scale[1]))
+        self.image.set_clim(*self.scale)
+
+    def update_scale(self, eit_image):
+        """
+        Update the colour limits for a new image. Returns True if they changed.
+        """
+        if self.color_scale == "fixed":
+            return False
+
+        vmin = float(np.min(eit_image))
+        vmax = float(np.max(eit_image))
+        if self.color_scale == "decay" and self.target_scale is not None:
+            low, high = self.target_scale
+            vmin = vmin if vmin < low else low + (vmin - low) * (1 - self.scale_decay)
+            vmax = vmax if vmax > high else high + (vmax - high) * (1 - self.scale_decay)
+        self.target_scale = (vmin, vmax)
+
+        if self.scale is None:
+            self.set_scale(self.target_scale)
+            return True
+
+        low, high = self.scale
+        tolerance = self.redraw_tolerance * (high - low)
+        if abs(vmin - low) > tolerance or abs(vmax - high) > tolerance:
+            self.set_scale(self.target_scale)
+            return True
+        return False
+
+    def reset_scale(self):
+        if self.color_scale != "fixed":
+            self.scale = None
+            self.target_scale = None
+
+    def remove(self):
+        self.canvas.mpl_disconnect(self.draw_event_id)
+        self.figure.clear()
+
+
+class WaveformPlot:
+    """
+    Scrolling plot of the frame summaries (see summaries), e.g. the global impedance waveform.
+
+    The summaries of the last n_points frames are kept in a fixed size ring buffer: add only writes into it, and draw
+    sets the lines' data from it. The x axis is the time in seconds before the newest frame, so it never moves, and the
+    lines are blitted onto a cached copy of the axes. The axes are only redrawn when the y limits have to change by
+    more than redraw_tolerance times their range.
+    """
+    def __init__(self, figure, names, series=None, seconds=20, n_points=5000, redraw_tolerance=0.05,
+                 title="Global impedance"):
+        self.figure = figure
+        self.canvas = figure.canvas
+        self.seconds = seconds
+        self.redraw_tolerance = redraw_tolerance
+        series = [name for name in names if name != "delta_v"] if series is None else series
+        self.columns = [names.index(name) for name in series]
+        self.times = np.full(n_points, np.nan)
+        self.values = np.full((n_points, len(names)), np.nan)
+        self.n_added = 0
+        self.updated = False
+        self.ylim = None
+
+        self.ax = figure.subplots()
+        self.lines = [self.ax.plot([], [], label=name, animated=True)[0] for name in series]
+        self.ax.set_xlim(-seconds, 0)
+        self.ax.set_xlabel("Seconds")
+        self.ax.set_title(title)
+        self.ax.legend(loc="upper left")
+
+        self.blit_background = None
+        self.draw_event_id = self.canvas.mpl_connect("draw_event", self.on_draw)
+
+    def on_draw(self, event):
+        self.blit_background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.draw_animated()
+
+    def draw_animated(self):
+        for line in self.lines:
+            self.ax.draw_artist(line)
+
+    def add(self, timestamps, values):
+        """
+        Add the (n_frames x n_summaries) values of frames with the given timestamps (in seconds).
+        """
+        n_points = len(self.times)
+        timestamps, values = timestamps[-n_points:], values[-n_points:]
+        slots = (self.n_added + np.arange(len(timestamps))) % n_points
+        self.times[slots] = timestamps
+        self.values[slots] = values
+        self.n_added += len(timestamps)
+        self.updated = True
+
+    def draw(self):
+        if not self.updated:
+            return
+        self.updated = False
+        # Oldest first, so the lines are drawn in time order
+        order = np.roll(np.arange(len(self.times)), -(self.n_added % len(self.times)))
+        x = self.times[order] - self.times[(self.n_added - 1) % len(self.times)]
+        for line, column in zip(self.lines, self.columns):
+            line.set_data(x, self.values[order, column])
+
+        if self.update_ylim(self.values[order][x >= -self.seconds][:, self.columns]) or self.blit_background is None:
+            self.canvas.draw_idle()
+        else:
+            self.canvas.restore_region(self.blit_background)
+            self.draw_animated()
+            self.canvas.blit(self.ax.bbox)
+
+    def update_ylim(self, visible):
+        """
+        Update the y limits to the visible values. Returns True if they changed.
+        """
+        if not np.any(np.isfinite(visible)):
+            return False
+        low, high = float(np.nanmin(visible)), float(np.nanmax(visible))
+        margin = 0.05 * (high - low) if high > low else max(abs(high), 1) * 0.05
+        low, high = low - margin, high + margin
+        if self.ylim is not None:
+            tolerance = self.redraw_tolerance * (self.ylim[1] - self.ylim[0])
+            if abs(low - self.ylim[0]) <= tolerance and abs(high - self.ylim[1]) <= tolerance:
+                return False
+        self.ylim = (low, high)
+        self.ax.set_ylim(*self.ylim)
+        return True
+
+    def clear(self):
+        self.times[:] = np.nan
+        self.values[:] = np.nan
+        self.n_added = 0
+        self.updated = True
+
+    def remove(self):
+        self.canvas.mpl_disconnect(self.draw_event_id)
+        self.figure.clear()
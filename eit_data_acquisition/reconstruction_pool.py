@@ -0,0 +1,67 @@
+"""
+Parallel, lossless reconstruction of frames in a pool of worker processes.
+"""
+
+import os
+import queue
+import threading
+from multiprocessing import Pool
+from eit_data_acquisition.eit import process_frame, create_solver, create_interpolation
+
+# Reconstruction object and configuration of a pool worker process, set once when the worker starts
+worker_state = {}
+
+
+def init_reconstruction_worker(eit_obj, conf):
+    worker_state["eit_obj"] = eit_obj
+    worker_state["conf"] = conf
+    # Solvers that carry state between frames (gn_streaming) only see the frames of their own worker
+    worker_state["solver"] = create_solver(eit_obj, conf)
+    worker_state["interpolation"] = create_interpolation(eit_obj, conf)
+
+
+def reconstruct(frame, background, frame_info):
+    frame_info["stage_times"] = dict(frame_info.get("stage_times", {}))
+    eit_image = process_frame(worker_state["eit_obj"], frame, worker_state["conf"], background,
+                              frame_info["stage_times"], worker_state["solver"], worker_state["interpolation"])
+    return eit_image, frame_info
+
+
+class ReconstructionPool:
+    """
+    Reconstructs frames in n_workers processes and hands the results to on_result, from a thread, in the order the
+    frames were submitted. submit blocks while max_pending frames are in flight.
+    """
+    def __init__(self, eit_obj, conf, on_result, n_workers=None, max_pending=None):
+        self.n_workers = os.cpu_count() if n_workers is None else n_workers
+        self.max_pending = 2 * self.n_workers if max_pending is None else max_pending
+        self.on_result = on_result
+        self.pool = Pool(self.n_workers, initializer=init_reconstruction_worker, initargs=(eit_obj, conf))
+        self.slots = threading.Semaphore(self.max_pending)
+        self.pending = queue.Queue()
+        self.thread = threading.Thread(target=self.forward_results, daemon=True)
+        self.thread.start()
+
+    def submit(self, frame, background, frame_info):
+        self.slots.acquire()
+        self.pending.put(self.pool.apply_async(reconstruct, (frame, background, frame_info)))
+
+    def forward_results(self):
+        while True:
+            async_result = self.pending.get()
+            if async_result is None:
+                return
+            try:
+                self.on_result(async_result.get())
+            except Exception as e:
+                print(e)
+            self.slots.release()
+
+    def close(self):
+        """
+        Wait for the frames in flight to be reconstructed and handed to on_result, then stop the workers.
+        """
+        self.pending.put(None)
+        self.thread.join()
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,325 @@
+"""
+Binary recording format
+
+A recording file is a small header followed by a flat array of fixed size records:
+
+    magic (8 bytes) | header length (uint32) | JSON header | padding | record | record | ...
+
+The JSON header holds the numpy record dtype and a metadata dict. An interrupted recording is readable up to the last
+complete record. Recordings can be gzip compressed as a whole.
+"""
+
+import gzip
+import json
+import queue
+import struct
+import threading
+from time import time
+import numpy as np
+
+recording_magic = b"EITREC01"
+recording_alignment = 64
+
+
+def frame_record_dtype(n_channels, frame_dtype="float64"):
+    return np.dtype([("timestamp", "<i8"), ("frame", frame_dtype, (n_channels,))])
+
+
+def merged_record_dtype(frame_lengths, frame_dtype="float64"):
+    """
+    Record dtype of frames captured together by several devices: the group's timestamp and one frame field per tag.
+    frame_lengths is a dict of tag: number of channels.
+    """
+    return np.dtype([("timestamp", "<i8")] + [(tag, frame_dtype, (n_channels,))
+                                              for tag, n_channels in frame_lengths.items()])
+
+
+def image_record_dtype(n_nodes, image_dtype="float64"):
+    """
+    Record dtype of reconstructed images: sequence number, timestamp, background version and node values.
+    """
+    return np.dtype([("sequence", "<i8"), ("timestamp", "<i8"), ("background_version", "<i8"),
+                     ("image", image_dtype, (n_nodes,))])
+
+
+def background_record_dtype(n_channels, frame_dtype="float64"):
+    return np.dtype([("background_version", "<i8"), ("timestamp", "<i8"), ("frame", frame_dtype, (n_channels,))])
+
+
+def timestamp_to_ns(timestamp):
+    return np.int64(round(timestamp * 1e9))
+
+
+def dtype_to_json(dtype):
+    return [[name, dtype.fields[name][0].base.str, list(dtype.fields[name][0].shape)] for name in dtype.names]
+
+
+def dtype_from_json(fields):
+    return np.dtype([(name, base, tuple(shape)) for name, base, shape in fields])
+
+
+class ChunkedRecordingWriter:
+    """
+    Appends structured numpy records to a binary recording file, in one write every flush_interval seconds.
+
+    The header is written right away if dtype is given, and otherwise with the first records. A recording closed before
+    any records gets a header with no frame channels, so that it still loads, as an empty recording.
+    """
+    def __init__(self, file, metadata=None, flush_interval=1.0, dtype=None):
+        self.file = file
+        self.metadata = metadata if metadata is not None else {}
+        self.flush_interval = flush_interval
+        self.dtype = None
+        self.chunks = []
+        self.n_records = 0
+        self.n_rejected = 0
+        self.last_flush = time()
+        self.held_back = []
+        self.held_back_since = None
+        self.merged_tags = None
+        if dtype is not None:
+            self.write_header(dtype)
+
+    @property
+    def name(self):
+        return self.file.name
+
+    def write_header(self, dtype):
+        self.dtype = dtype
+        header = json.dumps({"dtype": dtype_to_json(dtype), "metadata": self.metadata}, default=str).encode("utf-8")
+        data_start = len(recording_magic) + 4 + len(header)
+        padding = (-data_start) % recording_alignment
+        header += b" " * padding
+        self.file.write(recording_magic + struct.pack("<I", len(header)) + header)
+
+    def append(self, records):
+        if len(records) == 0:
+            return
+        if self.dtype is None:
+            self.write_header(records.dtype)
+        self.chunks.append(np.asarray(records, dtype=self.dtype))
+        self.n_records += len(records)
+
+        if time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def append_frames(self, timestamps, frames):
+        """
+        Build frame records from timestamps (in seconds) and frames, and append them. Frames whose length does not match
+        the first recorded frame are rejected.
+        """
+        if len(frames) == 0:
+            return
+        if self.dtype is None:
+            dtype = frame_record_dtype(len(frames[0]), self.metadata.get("frame_dtype", "float64"))
+        else:
+            dtype = self.dtype
+        n_channels = dtype["frame"].shape[0]
+
+        keep = [i for i, frame in enumerate(frames) if len(frame) == n_channels]
+        self.n_rejected += len(frames) - len(keep)
+
+        records = np.empty(len(keep), dtype=dtype)
+        records["timestamp"] = [timestamp_to_ns(timestamps[i]) for i in keep]
+        records["frame"] = [frames[i] for i in keep]
+        self.append(records)
+
+    def append_merged(self, timestamps, groups, tags):
+        """
+        Append groups, dicts of tag: frame, with their timestamps (in seconds). Missing or mismatched frames are
+        recorded as NaN. Records are held back until every tag has sent a frame, for at most flush_interval seconds.
+        """
+        self.merged_tags = tags
+        if self.dtype is None:
+            self.held_back.extend(zip(timestamps, groups))
+            if self.held_back_since is None:
+                self.held_back_since = time()
+            frame_lengths = {}
+            for _, group in self.held_back:
+                for tag, frame in group.items():
+                    if tag in tags and frame is not None and tag not in frame_lengths:
+                        frame_lengths[tag] = len(frame)
+            if len(frame_lengths) < len(tags) and time() - self.held_back_since < self.flush_interval:
+                return
+            missing = [tag for tag in tags if tag not in frame_lengths]
+            if len(missing) > 0:
+                print("No frames from {}, they are not recorded".format(", ".join(missing)))
+            self.write_header(merged_record_dtype({tag: frame_lengths[tag] for tag in tags if tag in frame_lengths},
+                                                  self.metadata.get("frame_dtype", "float64")))
+            timestamps, groups = zip(*self.held_back) if len(self.held_back) > 0 else ((), ())
+            self.held_back = []
+
+        records = np.empty(len(groups), dtype=self.dtype)
+        records["timestamp"] = [timestamp_to_ns(timestamp) for timestamp in timestamps]
+        for tag in self.dtype.names[1:]:
+            n_channels = self.dtype[tag].shape[0]
+            records[tag] = np.nan
+            for i, group in enumerate(groups):
+                frame = group.get(tag)
+                if frame is not None and len(frame) == n_channels:
+                    records[tag][i] = frame
+                elif frame is not None:
+                    self.n_rejected += 1
+        self.append(records)
+
+    def flush(self):
+        if len(self.chunks) > 0:
+            self.file.write(np.concatenate(self.chunks).tobytes())
+            self.chunks = []
+        self.file.flush()
+        self.last_flush = time()
+
+    def close(self):
+        if len(self.held_back) > 0:
+            # Record what was held back, even if some tags never sent a frame
+            self.held_back_since = -np.inf
+            self.append_merged((), (), self.merged_tags)
+        if self.dtype is None:
+            self.write_header(frame_record_dtype(0, self.metadata.get("frame_dtype", "float64")))
+        self.flush()
+        self.file.close()
+
+
+class ImageRecorder:
+    """
+    Records reconstructed images to image_file and their backgrounds to background_file, from a writer thread. Items
+    queued while the writer is more than max_queue behind, or once close has begun, are dropped and counted in
+    n_dropped.
+    """
+    def __init__(self, image_file, background_file, n_nodes, n_channels, metadata=None, flush_interval=1.0,
+                 max_queue=10000, image_dtype="float64"):
+        self.image_dtype = image_record_dtype(n_nodes, image_dtype)
+        self.background_dtype = background_record_dtype(n_channels)
+        self.image_writer = ChunkedRecordingWriter(image_file, metadata, flush_interval, self.image_dtype)
+        self.background_writer = ChunkedRecordingWriter(background_file, metadata, flush_interval,
+                                                        self.background_dtype)
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(max_queue)
+        self.n_images = 0
+        self.n_dropped = 0
+        self.closed = False
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+
+    @property
+    def name(self):
+        return self.image_writer.name
+
+    def add_image(self, sequence, timestamp, background_version, image):
+        self.put(("image", (sequence, timestamp_to_ns(timestamp), background_version, image)))
+
+    def add_background(self, background_version, timestamp, background):
+        if background is None:
+            background = np.full(self.background_dtype["frame"].shape, np.nan)
+        self.put(("background", (background_version, timestamp_to_ns(timestamp), background)))
+
+    def put(self, item):
+        with self.lock:
+            if self.closed:
+                self.n_dropped += 1
+                return
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                self.n_dropped += 1
+
+    def write_loop(self):
+        while True:
+            try:
+                items = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                # Nothing new, but the last batch may still be waiting to be flushed
+                self.image_writer.flush()
+                self.background_writer.flush()
+                continue
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            images = [data for kind, data in items if kind == "image"]
+            backgrounds = [data for kind, data in items if kind == "background"]
+            # Backgrounds first, so that an image's background is always on disk when the image is
+            if len(backgrounds) > 0:
+                self.background_writer.append(np.array(backgrounds, dtype=self.background_dtype))
+            if len(images) > 0:
+                self.image_writer.append(np.array(images, dtype=self.image_dtype))
+                self.n_images += len(images)
+            if any(kind == "close" for kind, _ in items):
+                return
+
+    def close(self):
+        """
+        Write what is still queued and close the files.
+        """
+        with self.lock:
+            self.closed = True
+            self.queue.put(("close", None))
+        self.thread.join()
+        self.image_writer.close()
+        self.background_writer.close()
+
+
+def is_gzip_file(file_name):
+    with open(file_name, "rb") as f:
+        return f.read(2) == b"\x1f\x8b"
+
+
+def open_recording(file_name):
+    """
+    Open a binary recording for reading, decompressing it as it is read if it is gzip compressed.
+    """
+    if is_gzip_file(file_name):
+        return gzip.open(file_name, "rb")
+    return open(file_name, "rb")
+
+
+def read_recording_header(file):
+    magic = file.read(len(recording_magic))
+    if magic != recording_magic:
+        raise ValueError("Not an EIT recording file: " + str(file.name))
+    header_length, = struct.unpack("<I", file.read(4))
+    header = json.loads(file.read(header_length).decode("utf-8"))
+    data_start = len(recording_magic) + 4 + header_length
+    return dtype_from_json(header["dtype"]), header["metadata"], data_start
+
+
+def load_recording(file_name, mmap_mode=None):
+    """
+    Load a binary recording in a single read.
+
+    Parameters
+    ----------
+    file_name
+    mmap_mode: If not None, the records are memory mapped with this mode (e.g. "r") instead of read into memory. Ignored
+        for compressed recordings
+
+    Returns
+    -------
+    records: structured array with fields "timestamp" (int64, ns since the epoch) and "frame" (n_records x n_channels),
+        or one field per tag instead of "frame" for recordings of several devices (see merged_record_dtype)
+    metadata: dict
+    """
+    if is_gzip_file(file_name):
+        with gzip.open(file_name, "rb") as f:
+            dtype, metadata, data_start = read_recording_header(f)
+            data = f.read()
+        # A trailing partial record (e.g. from an interrupted recording) is ignored
+        n_records = len(data) // dtype.itemsize
+        return np.frombuffer(data, dtype=dtype, count=n_records), metadata
+
+    with open(file_name, "rb") as f:
+        dtype, metadata, data_start = read_recording_header(f)
+        f.seek(0, 2)
+        # A trailing partial record (e.g. from an interrupted recording) is ignored
+        n_records = (f.tell() - data_start) // dtype.itemsize
+
+        if mmap_mode is not None and n_records > 0:
+            records = np.memmap(f, dtype=dtype, mode=mmap_mode, offset=data_start, shape=(n_records,))
+        else:
+            f.seek(data_start)
+            records = np.fromfile(f, dtype=dtype, count=n_records)
+
+    return records, metadata
@@ -0,0 +1,232 @@
+"""
+Shared memory buffers for passing frames between processes without pickling them.
+"""
+
+import atexit
+import sys
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+
+
+def attach_shared_memory(name):
+    """
+    Attach to an existing shared memory block without registering it with this process's resource tracker. Only the
+    creating process unlinks the block, so tracking it in attaching processes would only produce spurious "leaked
+    shared_memory" warnings (and premature unlinking) when they exit.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    shm = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+class SharedArrays:
+    """
+    A set of numpy arrays laid out in one shared memory block.
+
+    Created in the main process with create=True, and attached to by name when unpickled in a worker process (so it can
+    be passed in work_kwargs like any other argument). The creator unlinks the block at exit.
+    """
+    def __init__(self, layout, name=None):
+        # layout: list of (array name, dtype, shape)
+        self.layout = [(array_name, np.dtype(dtype), tuple(shape)) for array_name, dtype, shape in layout]
+        size = sum(dtype.itemsize * int(np.prod(shape)) for _, dtype, shape in self.layout)
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+            self.owner = True
+            atexit.register(self.unlink)
+        else:
+            self.shm = attach_shared_memory(name)
+            self.owner = False
+        self.arrays = {}
+        offset = 0
+        for array_name, dtype, shape in self.layout:
+            self.arrays[array_name] = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+            offset += dtype.itemsize * int(np.prod(shape))
+
+    def __getstate__(self):
+        return {"layout": self.layout, "name": self.shm.name}
+
+    def __setstate__(self, state):
+        self.__init__(state["layout"], name=state["name"])
+
+    def __getitem__(self, array_name):
+        return self.arrays[array_name]
+
+    def unlink(self):
+        if self.owner:
+            self.owner = False
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+            try:
+                self.shm.close()
+            except BufferError:
+                # Arrays viewing the block are still alive. The mapping is released when they are garbage collected
+                pass
+
+
+class FrameRing:
+    """
+    Fixed size ring of frame slots in shared memory, written by one Reader and read by any number of consumers.
+
+    Each slot holds a frame, its timestamp and its sequence number. The writer marks a slot as being written (sequence
+    -1) while copying into it, so a reader can detect that a slot was overwritten during its copy by checking the slot
+    sequence before and after. Consumers read through a RingCursor.
+    """
+    def __init__(self, n_slots, n_channels, tag, dtype="float64", shared=None):
+        self.n_slots = n_slots
+        self.n_channels = n_channels
+        self.tag = tag
+        self.dtype = dtype
+        if shared is None:
+            shared = SharedArrays([("head", "i8", (1,)),
+                                   ("sequence", "i8", (n_slots,)),
+                                   ("timestamp", "f8", (n_slots,)),
+                                   ("frame", dtype, (n_slots, n_channels))])
+            shared["head"][0] = 0
+            shared["sequence"][:] = -1
+        self.shared = shared
+        self.head = shared["head"]
+        self.sequence = shared["sequence"]
+        self.timestamp = shared["timestamp"]
+        self.frame = shared["frame"]
+
+    def __getstate__(self):
+        return {"n_slots": self.n_slots, "n_channels": self.n_channels, "tag": self.tag, "dtype": self.dtype,
+                "shared": self.shared}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def write(self, frame, timestamp):
+        """
+        Copy frame into the next slot. Returns the sequence number of the frame, or None if the frame does not have
+        n_channels items.
+        """
+        if len(frame) != self.n_channels:
+            return None
+        seq = int(self.head[0])
+        slot = seq % self.n_slots
+        self.sequence[slot] = -1
+        self.frame[slot] = frame
+        self.timestamp[slot] = timestamp
+        self.sequence[slot] = seq
+        self.head[0] = seq + 1
+        return seq
+
+    def read(self, seq):
+        """
+        Returns (frame, timestamp) for sequence number seq, or None if it has not been written or was overwritten.
+        """
+        slot = seq % self.n_slots
+        if self.sequence[slot] != seq:
+            return None
+        frame = self.frame[slot].copy()
+        timestamp = float(self.timestamp[slot])
+        if self.sequence[slot] != seq:
+            return None
+        return frame, timestamp
+
+    def unlink(self):
+        self.shared.unlink()
+
+
+class RingCursor:
+    """
+    A consumer's read position in a FrameRing.
+
+    A lossless cursor returns every frame written since its last read, unless the writer has lapped it, in which case
+    the overwritten frames are counted in dropped. A lossy cursor returns only the newest frame and skips the rest.
+    """
+    def __init__(self, ring, lossy=False):
+        self.ring = ring
+        self.lossy = lossy
+        self.next = int(ring.head[0])
+        self.dropped = 0
+
+    def read(self):
+        """
+        Returns a list of Reader style messages ({"tag", "data", "timestamp", "sequence"}) for the new frames.
+        """
+        ring = self.ring
+        head = int(ring.head[0])
+        start = max(self.next, head - ring.n_slots)
+        if self.lossy:
+            start = max(start, head - 1)
+        self.dropped += start - self.next
+        self.next = head
+        if head <= start:
+            return []
+
+        seqs = np.arange(start, head)
+        slots = seqs % ring.n_slots
+        frames = ring.frame[slots]  # copies
+        timestamps = ring.timestamp[slots]
+        valid = ring.sequence[slots] == seqs
+        self.dropped += int(np.count_nonzero(~valid))
+
+        return [{"tag": ring.tag, "data": frames[i], "timestamp": float(timestamps[i]), "sequence": int(seqs[i])}
+                for i in np.flatnonzero(valid)]
+
+
+class SharedFrame:
+    """
+    A single frame (or None) in shared memory, guarded by a seqlock.
+
+    The writer makes the version odd while it copies the frame in and even again when done. Readers retry if the version
+    was odd or changed during their copy, so get never returns a torn frame. Readers that only need to know whether the
+    frame changed can compare get_version() with the version they last read, which costs no copy at all. Only one
+    process should write at a time.
+    """
+    def __init__(self, n_channels, dtype="float64", shared=None):
+        self.n_channels = n_channels
+        self.dtype = dtype
+        if shared is None:
+            shared = SharedArrays([("version", "i8", (1,)),
+                                   ("valid", "i8", (1,)),
+                                   ("frame", dtype, (n_channels,))])
+            shared["version"][0] = 0
+            shared["valid"][0] = 0
+        self.shared = shared
+        self.version = shared["version"]
+        self.valid = shared["valid"]
+        self.frame = shared["frame"]
+
+    def __getstate__(self):
+        return {"n_channels": self.n_channels, "dtype": self.dtype, "shared": self.shared}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def set(self, frame):
+        if frame is not None and len(frame) != self.n_channels:
+            raise ValueError("Expected a frame of length {}, got {}".format(self.n_channels, len(frame)))
+        version = int(self.version[0])
+        self.version[0] = version + 1
+        if frame is None:
+            self.valid[0] = 0
+        else:
+            self.frame[:] = frame
+            self.valid[0] = 1
+        self.version[0] = version + 2
+
+    def get(self):
+        """
+        Returns a copy of the frame, or None if it is not set.
+        """
+        while True:
+            version = int(self.version[0])
+            if version % 2 == 1:
+                continue
+            frame = self.frame.copy() if self.valid[0] else None
+            if int(self.version[0]) == version:
+                return frame
+
+    def get_version(self):
+        return int(self.version[0])
+
+    def unlink(self):
+        self.shared.unlink()
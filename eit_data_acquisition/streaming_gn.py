@@ -0,0 +1,137 @@
+import copy
+import threading
+import numpy as np
+from time import perf_counter
+from scipy.linalg import cho_factor, cho_solve
+
+
+class StreamingGaussNewton:
+    """
+    Gauss-Newton reconstruction of a stream of frames, warm started from the previous frame.
+
+    The forward model is linearized around x_lin and only relinearized when the conductivity has moved more than
+    relinearize_tolerance (relative) away from it. The update is computed in measurement space, where the Cholesky
+    factorization of J R^-1 J^T + lamb I is computed once per linearization point and lamb.
+
+    Iterations stop after maxiter, when the update is below gtol (relative), or after time_budget seconds. With a
+    time_budget, relinearization runs in a background thread, and the frames keep using the old linearization until it
+    is done.
+    """
+    def __init__(self, pyeit_obj, p=None, lamb=None, method=None, lamb_decay=1.0, lamb_min=0.0, maxiter=1, gtol=1e-4,
+                 time_budget=None, relinearize_tolerance=0.05):
+        self.pyeit_obj = pyeit_obj
+        self.p = pyeit_obj.params["p"] if p is None else p
+        self.lamb = pyeit_obj.params["lamb"] if lamb is None else lamb
+        self.method = pyeit_obj.params["method"] if method is None else method
+        self.lamb_decay = lamb_decay
+        self.lamb_min = lamb_min
+        self.maxiter = maxiter
+        self.gtol = gtol
+        self.time_budget = time_budget
+        self.relinearize_tolerance = relinearize_tolerance
+        # The regularization of each iteration, so that their factorizations can be computed with the linearization
+        self.lambs = [self.lamb]
+        for _ in range(maxiter - 1):
+            self.lambs.append(max(self.lambs[-1] * lamb_decay, lamb_min))
+
+        self.x = np.array(pyeit_obj.mesh.perm_array, dtype=float)
+        self.x_norm = np.linalg.norm(self.x)
+        self.relinearize_time = None
+        self.n_relinearizations = 0
+        self.relinearize_thread = None
+        self.relinearize_result = None
+        self.n_iterations = 0
+        self.set_linearization(self.linearize(self.x, pyeit_obj.J, pyeit_obj.v0))
+
+    def linearize(self, x, jac, v):
+        """
+        Everything the updates need from the linearization at x, including the factorizations for self.lambs.
+        """
+        jac = np.asarray(jac)
+        j_w_j_diag = np.einsum("ij,ij->j", jac, jac)
+        if self.method == "kotre":
+            r_diag = j_w_j_diag ** self.p
+        elif self.method == "lm":
+            r_diag = j_w_j_diag
+        else:
+            r_diag = np.ones(jac.shape[1])
+        jac_r = jac / r_diag  # J R^-1
+        gram = jac_r @ jac.T  # J R^-1 J^T
+        factorizations = {lamb: cho_factor(gram + lamb * np.eye(len(gram))) for lamb in set(self.lambs)}
+        return np.array(x), jac, np.asarray(v), jac_r, gram, factorizations
+
+    def set_linearization(self, linearization):
+        self.x_lin, self.jac, self.v_lin, self.jac_r, self.gram, self.factorizations = linearization
+
+    def relinearize(self):
+        start = perf_counter()
+        jac, v = self.pyeit_obj.fwd.compute_jac(self.x)
+        self.set_linearization(self.linearize(self.x, jac, v))
+        self.relinearize_time = perf_counter() - start
+        self.n_relinearizations += 1
+
+    def start_relinearization(self):
+        # compute_jac assembles the system matrix into the forward model, so the thread works on its own copy
+        fwd = copy.copy(self.pyeit_obj.fwd)
+        x = self.x.copy()
+
+        def run():
+            start = perf_counter()
+            jac, v = fwd.compute_jac(x)
+            self.relinearize_result = self.linearize(x, jac, v)
+            self.relinearize_time = perf_counter() - start
+
+        self.relinearize_thread = threading.Thread(target=run, daemon=True)
+        self.relinearize_thread.start()
+
+    def update_linearization(self):
+        """
+        Swap in a finished background relinearization, and start one (or relinearize right away without a
+        time_budget) if the conductivity has moved too far from the linearization point.
+        """
+        if self.relinearize_thread is not None and not self.relinearize_thread.is_alive():
+            self.relinearize_thread = None
+            if self.relinearize_result is not None:
+                self.set_linearization(self.relinearize_result)
+                self.relinearize_result = None
+                self.n_relinearizations += 1
+
+        if self.relinearize_thread is None and \
+                np.linalg.norm(self.x - self.x_lin) > self.relinearize_tolerance * np.linalg.norm(self.x_lin):
+            if self.time_budget is None:
+                self.relinearize()
+            else:
+                self.start_relinearization()
+
+    def reset(self):
+        """
+        Forget the stream so far and start again from the mesh's conductivity.
+        """
+        self.x = np.array(self.pyeit_obj.mesh.perm_array, dtype=float)
+
+    def step(self, x, v, lamb):
+        residual = v - (self.v_lin - self.jac @ (x - self.x_lin))
+        if lamb not in self.factorizations:
+            self.factorizations[lamb] = cho_factor(self.gram + lamb * np.eye(len(self.gram)))
+        return self.jac_r.T @ cho_solve(self.factorizations[lamb], residual)
+
+    def solve(self, v):
+        """
+        Reconstruct the conductivity on the mesh elements from the measurements of one frame.
+        """
+        start = perf_counter()
+        self.update_linearization()
+        x = self.x
+
+        self.n_iterations = 0
+        for lamb in self.lambs:
+            d = self.step(x, v, lamb)
+            x = x - d
+            self.n_iterations += 1
+            if np.linalg.norm(d) < self.gtol * self.x_norm:
+                break
+            if self.time_budget is not None and perf_counter() - start >= self.time_budget:
+                break
+
+        self.x = x
+        return x
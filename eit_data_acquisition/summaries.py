@@ -0,0 +1,82 @@
+"""
+Scalar summaries of each frame for the global impedance (tidal volume) waveform.
+
+Per frame:
+    "global": the sum of the image's node values, the global impedance change
+    "delta_v": the sum of the voltage changes against the background
+    one sum of the image's node values per region of interest
+
+The "solve" image is linear in the voltage change, so the sums are computed from the voltage changes with precomputed
+weights, without reconstructing the images.
+"""
+
+import numpy as np
+from eit_data_acquisition.eit import create_solver, create_interpolation
+
+
+def roi_masks(node, rois):
+    """
+    Masks of the mesh nodes in each region of interest.
+
+    Parameters
+    ----------
+    node: (n_nodes x 2 or 3) array of node coordinates
+    rois: dict of name: region, where a region is {"circle": [x, y, radius]} or {"polygon": [[x, y], ...]}, in the
+        mesh's coordinates
+
+    Returns
+    -------
+    (len(rois) x n_nodes) boolean array, in the order of rois
+    """
+    masks = np.zeros((len(rois), len(node)), dtype=bool)
+    for i, (name, region) in enumerate(rois.items()):
+        if "circle" in region:
+            x, y, radius = region["circle"]
+            masks[i] = np.hypot(node[:, 0] - x, node[:, 1] - y) <= radius
+        elif "polygon" in region:
+            from matplotlib.path import Path
+            masks[i] = Path(region["polygon"]).contains_points(node[:, :2])
+        else:
+            raise ValueError("Region of interest {} is neither a circle nor a polygon".format(name))
+    return masks
+
+
+class FrameSummaries:
+    """
+    Summarizes frames reconstructed by a LinearSolver and interpolated to the nodes, in float64.
+    """
+    def __init__(self, solver, interpolation, node, rois=None):
+        rois = {} if rois is None else rois
+        self.names = ["global", "delta_v"] + list(rois)
+        self.solver = solver
+        masks = np.vstack([np.ones((1, len(node))), roi_masks(node, rois)])
+        # image = interpolation @ (-H @ dv), so masks @ image = (-(masks @ interpolation) @ H) @ dv
+        element_weights = (interpolation.T.astype(np.float64) @ masks.T).T
+        self.weights = -(element_weights @ solver.H.astype(np.float64))
+
+    def summarize(self, frames, background):
+        """
+        Summarize an (n_frames x n_channels) array of frames against the background frame.
+
+        Returns
+        -------
+        (n_frames x len(names)) array
+        """
+        dv = self.solver.voltage_change(frames, background)
+        summaries = np.empty((len(dv), len(self.names)))
+        image_sums = dv @ self.weights.T
+        summaries[:, 0] = image_sums[:, 0]
+        summaries[:, 1] = dv.sum(axis=1)
+        summaries[:, 2:] = image_sums[:, 1:]
+        return summaries
+
+
+def create_summaries(pyeit_obj, conf, solver=None, interpolation=None):
+    """
+    Create the FrameSummaries of conf["rois"], or None for the Gauss-Newton solve types.
+    """
+    if conf["solve_type"] != "solve":
+        return None
+    solver = create_solver(pyeit_obj, conf) if solver is None else solver
+    interpolation = create_interpolation(pyeit_obj, conf) if interpolation is None else interpolation
+    return FrameSummaries(solver, interpolation, pyeit_obj.mesh.node, conf.get("rois"))
@@ -0,0 +1,250 @@
+"""
+Virtual EIT devices, for running the acquisition pipeline without hardware.
+
+A VirtualEITDevice behaves like the serial port the Reader reads from (read, in_waiting, flushInput, close) and emits
+frames as text lines in the device's format at a set rate. Frames either come from a forward simulation on the
+configured mesh, or from a recorded file (binary recording, csv recording or plain frame file) replayed at its original
+rate or a multiple of it.
+
+The Reader opens a virtual device directly when the device name is virtual_device_name or starts with
+replay_device_prefix. serve_on_pty exposes a virtual device on a pseudo-terminal instead, so that anything able to open
+a serial port can read from it.
+"""
+
+import csv
+import gzip
+import os
+from time import perf_counter, sleep
+import numpy as np
+from eit_data_acquisition.eit import setup_forward_model, format_oeit_line, parse_oeit_line, load_oeit_data
+from eit_data_acquisition.recording import recording_magic, load_recording, open_recording, is_gzip_file
+
+virtual_device_name = "Virtual EIT"
+replay_device_prefix = "Replay: "
+
+
+class VirtualEITDevice:
+    """
+    Serial port stand-in that emits frames as text lines on a schedule.
+
+    Frame i of the sequence is due frame_times[i] seconds after the device is opened. When loop is set the sequence
+    repeats every period seconds, otherwise the device goes quiet after the last frame. Lines are formatted once up
+    front, so the device itself costs almost nothing at high frame rates and the measured limits are the pipeline's.
+    """
+    def __init__(self, frames, frame_times, period=None, loop=True, timeout=None, prefix="magnitudes: ",
+                 separator=", ", termination="\n", encoding="latin-1"):
+        if len(frames) == 0:
+            raise ValueError("A virtual device needs at least one frame")
+        self.lines = [(format_oeit_line(frame, prefix, separator) + termination).encode(encoding) for frame in frames]
+        self.frame_times = np.asarray(frame_times, dtype=float)
+        if period is None:
+            period = self.frame_times[-1] + (np.median(np.diff(self.frame_times)) if len(frames) > 1 else 1)
+        self.period = float(period)
+        self.loop = loop
+        self.timeout = timeout
+        self.pending = bytearray()
+        self.n_sent = 0
+        self.start_time = perf_counter()
+        self.is_open = True
+
+    def due_time(self, n):
+        cycle, index = divmod(n, len(self.lines))
+        if cycle > 0 and not self.loop:
+            return np.inf
+        return cycle * self.period + self.frame_times[index]
+
+    def generate(self):
+        now = perf_counter() - self.start_time
+        while self.due_time(self.n_sent) <= now:
+            self.pending += self.lines[self.n_sent % len(self.lines)]
+            self.n_sent += 1
+
+    @property
+    def in_waiting(self):
+        self.generate()
+        return len(self.pending)
+
+    def read(self, size=1):
+        """
+        Like serial.Serial.read: wait until size bytes are available or the timeout expires, and return them.
+        """
+        deadline = None if self.timeout is None else perf_counter() + self.timeout
+        self.generate()
+        while len(self.pending) < size and self.is_open:
+            wait = self.start_time + self.due_time(self.n_sent) - perf_counter()
+            if deadline is not None:
+                wait = min(wait, deadline - perf_counter())
+                if wait <= 0:
+                    break
+            if wait == np.inf:
+                break
+            sleep(max(wait, 0))
+            self.generate()
+        data = bytes(self.pending[:size])
+        del self.pending[:size]
+        return data
+
+    def flushInput(self):
+        self.generate()
+        self.pending.clear()
+
+    def close(self):
+        self.is_open = False
+
+
+def simulated_frames(forward_model, frame_rate=50, breathing_rate=0.25, amplitude=0.3, noise=0.01, seed=0):
+    """
+    One breathing cycle of frames simulated with forward_model (see eit.setup_forward_model).
+
+    Two elliptical lung regions lose amplitude of their conductivity at full inspiration. The two extreme states are
+    solved with the forward model, the frames in between are interpolated between them with a (1 - cos) breathing
+    waveform, and gaussian noise of noise times the size of the breathing signal is added.
+
+    Returns
+    -------
+    frames: (n_frames x n_measurements) array
+    frame_times: (n_frames,) array of seconds from the start of the cycle
+    """
+    mesh = forward_model.mesh
+    radius = np.max(np.hypot(mesh.node[:, 0], mesh.node[:, 1]))
+    centers = mesh.elem_centers[:, :2] / radius
+    lungs = np.zeros(len(centers), dtype=bool)
+    for x in (-0.35, 0.35):
+        lungs |= ((centers[:, 0] - x) / 0.2) ** 2 + ((centers[:, 1] - 0.1) / 0.35) ** 2 <= 1
+
+    perm = np.asarray(mesh.perm_array, dtype=float)
+    v_exhaled = forward_model.solve_eit(perm=perm)
+    v_inhaled = forward_model.solve_eit(perm=np.where(lungs, perm * (1 - amplitude), perm))
+
+    n_frames = max(1, int(round(frame_rate / breathing_rate)))
+    frame_times = np.arange(n_frames) / frame_rate
+    breath = (1 - np.cos(2 * np.pi * breathing_rate * frame_times)) / 2
+    signal = v_inhaled - v_exhaled
+    frames = v_exhaled + breath[:, None] * signal
+    frames += np.random.default_rng(seed).normal(scale=noise * np.sqrt(np.mean(signal ** 2)), size=frames.shape)
+    return frames, frame_times
+
+
+def load_replay_frames(file_name, tag="EIT", frame_rate=50, relative=True):
+    """
+    Load the frames of a recording for replay.
+
+    Binary recordings and csv recordings with raw timestamps, gzip compressed or not, are replayed with their recorded
+    timing. Files without
+    usable timestamps (csv with formatted timestamps, or plain files with one frame per line) are played at frame_rate.
+
+    Returns
+    -------
+    frames: (n_frames x n_channels) array
+    frame_times: (n_frames,) array of seconds from the first frame, or the recorded timestamps (seconds since the epoch)
+        if relative is False and the file has them
+    """
+    with open_recording(file_name) as f:
+        is_binary = f.read(len(recording_magic)) == recording_magic
+    compressed = is_gzip_file(file_name)
+    base_name = file_name[:-len(".gz")] if compressed and file_name.lower().endswith(".gz") else file_name
+
+    timestamps = None
+    if is_binary:
+        records, _ = load_recording(file_name)
+        # Recordings of several devices have one frame field per tag
+        frames = records["frame"] if "frame" in records.dtype.names else records[tag]
+        timestamps = records["timestamp"] / 1e9
+        if "frame" not in records.dtype.names:
+            # Drop the groups the device was missing from
+            recorded = ~np.isnan(frames).any(axis=1)
+            frames, timestamps = frames[recorded], timestamps[recorded]
+    elif os.path.splitext(base_name)[1].lower() == ".csv":
+        with (gzip.open(file_name, "rt", newline="") if compressed else open(file_name, "r", newline="")) as f:
+            rows = csv.reader(f)
+            columns = next(rows)
+            data_column = columns.index(tag)
+            time_column = columns.index("Time") if "Time" in columns else None
+            frames = []
+            times = []
+            for row in rows:
+                frame = parse_oeit_line(row[data_column]) if len(row) > data_column else None
+                if frame is None or (len(frames) > 0 and len(frame) != len(frames[0])):
+                    continue
+                frames.append(frame)
+                if time_column is not None:
+                    times.append(row[time_column])
+        frames = np.array(frames)
+        try:
+            timestamps = np.array(times, dtype=float) if len(times) == len(frames) else None
+        except ValueError:
+            timestamps = None
+    else:
+        frames = load_oeit_data(file_name)
+
+    if len(frames) == 0:
+        raise ValueError("No frames found in " + file_name)
+    if timestamps is None or np.any(np.diff(timestamps) < 0):
+        return frames, np.arange(len(frames)) / frame_rate
+    return frames, (timestamps - timestamps[0] if relative else timestamps)
+
+
+def open_virtual_device(device_name, configuration, timeout=None):
+    """
+    Open the virtual device named device_name.
+
+    Parameters
+    ----------
+    device_name: virtual_device_name, or replay_device_prefix followed by the file to replay
+    configuration: dict with optional keys
+        "mesh", "eit_setup": files used to simulate frames
+        "frame_rate": simulated frame rate, and replay frame rate of files without timestamps (default 50)
+        "rate_multiplier": replay speed relative to the recorded timing (default 1)
+        "breathing_rate", "amplitude", "noise": see simulated_frames
+        "loop": whether to repeat the frames forever (default True)
+        "tag": column replayed from csv recordings (default "EIT")
+    timeout: read timeout in seconds, as for serial.Serial
+    """
+    frame_rate = configuration.get("frame_rate", 50)
+    if device_name.startswith(replay_device_prefix):
+        frames, frame_times = load_replay_frames(device_name[len(replay_device_prefix):],
+                                                 tag=configuration.get("tag", "EIT"), frame_rate=frame_rate)
+        rate_multiplier = configuration.get("rate_multiplier", 1)
+        frame_times = frame_times / rate_multiplier
+        period = frame_times[-1] + 1 / (frame_rate * rate_multiplier)
+    elif device_name == virtual_device_name:
+        forward_model = setup_forward_model(configuration["mesh"], configuration["eit_setup"])
+        frames, frame_times = simulated_frames(forward_model, frame_rate=frame_rate,
+                                               breathing_rate=configuration.get("breathing_rate", 0.25),
+                                               amplitude=configuration.get("amplitude", 0.3),
+                                               noise=configuration.get("noise", 0.01))
+        period = len(frames) / frame_rate
+    else:
+        raise ValueError("Not a virtual device: " + device_name)
+
+    return VirtualEITDevice(frames, frame_times, period=period, loop=configuration.get("loop", True),
+                            timeout=timeout)
+
+
+def is_virtual_device(device_name):
+    return device_name == virtual_device_name or device_name.startswith(replay_device_prefix)
+
+
+def serve_on_pty(device):
+    """
+    Forward everything the device emits to a new pseudo-terminal until interrupted. The name of the terminal to open as
+    a serial port is printed. Only available on POSIX systems.
+    """
+    import tty
+
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    print("Virtual device on " + os.ttyname(slave))
+    try:
+        while True:
+            data = device.read(max(1, device.in_waiting))
+            if len(data) == 0:
+                # Without a timeout, read only comes back empty once a device that doesn't loop has run out of frames
+                break
+            os.write(master, data)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        device.close()
+        os.close(slave)
+        os.close(master)
@@ -0,0 +1,991 @@
+"""
+Acquisition, reconstruction and recording workers, without any GUI dependency.
+
+Results are passed to the main process through plain callbacks. background_process_workers wraps the workers in Qt
+objects that emit signals instead.
+"""
+
+from adv_prodcon import Producer, Consumer
+from multiprocessing import Array, Value
+import ctypes
+import os
+import threading
+import queue
+import gzip
+import json
+from datetime import datetime
+from time import time, perf_counter_ns
+from collections import deque
+import csv
+import numpy as np
+import serial
+from serial.tools import list_ports
+from eit_data_acquisition.eit import setup_eit, process_frame, create_solver, create_interpolation, \
+    reconstruction_dtype, parse_oeit_line, format_oeit_line, load_conf, load_background, mesh_geometry
+from eit_data_acquisition.recording import ChunkedRecordingWriter, ImageRecorder
+from eit_data_acquisition.shared_buffers import RingCursor, SharedFrame
+from eit_data_acquisition.framing import FrameBuffer
+from eit_data_acquisition.metrics import stamp
+from eit_data_acquisition.filters import create_frame_filter, create_rolling_average
+from eit_data_acquisition.summaries import create_summaries
+from eit_data_acquisition.reconstruction_pool import ReconstructionPool
+from eit_data_acquisition.virtual_device import (virtual_device_name, replay_device_prefix, is_virtual_device,
+                                                 open_virtual_device)
+
+
+def item_frame(item):
+    """
+    Get the frame in a Reader message as a float array, parsing it if the Reader sent the raw line. Returns None for
+    malformed lines.
+    """
+    data = item["data"]
+    if isinstance(data, str):
+        return parse_oeit_line(data)
+    return data
+
+
+def stack_frames(items, n_channels):
+    """
+    Stack the frames of items with n_channels channels into an (n_frames x n_channels) array.
+
+    Returns
+    -------
+    the items with such a frame, and the array (None if there are none)
+    """
+    framed = [(item, item_frame(item)) for item in items if item is not None]
+    framed = [(item, frame) for item, frame in framed if frame is not None and len(frame) == n_channels]
+    if len(framed) == 0:
+        return [], None
+    return [item for item, _ in framed], np.stack([frame for _, frame in framed])
+
+
+def item_text(item):
+    """
+    Get the frame in a Reader message as a line of text, formatting it if the Reader sent a parsed frame.
+    """
+    data = item["data"]
+    if isinstance(data, str):
+        return data
+    return format_oeit_line(data)
+
+
+def collect_items(items, shared_var):
+    """
+    Get the Reader messages to process from a Consumer's work items. With the FrameRing transport the queue items are
+    only notifications, and the frames are read from the ring through the Consumer's cursor instead.
+    """
+    messages = []
+    for item in items:
+        # Reader sends a list of messages per work loop iteration
+        if isinstance(item, list):
+            messages.extend(item)
+        elif item is not None:
+            messages.append(item)
+
+    ring_cursor = shared_var.get("ring_cursor")
+    if ring_cursor is not None:
+        # Carry over the stage timestamps of the notifications to the frames read from the ring
+        stage_times = {message["sequence"]: message["stage_times"] for message in messages if "stage_times" in message}
+        messages = ring_cursor.read()
+        for message in messages:
+            if message["sequence"] in stage_times:
+                message["stage_times"] = stage_times[message["sequence"]]
+    return messages
+
+
+def member_messages(item):
+    """
+    Get the Reader messages grouped in a FrameMerger message, or the Reader message itself.
+    """
+    if "frames" in item:
+        return list(item["frames"].values())
+    return [item]
+
+
+def select_tag(messages, tag):
+    """
+    Get the messages of the device tagged tag from Reader or FrameMerger messages.
+    """
+    return [message for item in messages for message in member_messages(item) if message["tag"] == tag]
+
+
+def create_ring_cursor(kwargs, lossy):
+    frame_ring = kwargs.get("frame_ring")
+    if frame_ring is None:
+        return None
+    return RingCursor(frame_ring, lossy=lossy)
+
+
+class ReaderWorker(Producer):
+    """
+        Reader sends lists of messages of type:
+            { "tag": string
+              "data":  any
+              "timestamp": time
+              "stage_times": {"read": ns, "parse": ns}}
+        with one message for every complete frame read in a work loop iteration, or None if there was none.
+        stage_times are time.perf_counter_ns() timestamps used to measure the pipeline (see metrics). "timestamp" is
+        when the frame's termination arrived, interpolated over the interval since the previous read (see
+        FrameBuffer.feed_timed).
+
+        If configuration["parse_frames"] is set, "data" is the parsed frame as a float array and malformed lines are
+        dropped in the Reader process. Otherwise it is the decoded line.
+
+        If a FrameRing is passed as work kwarg "frame_ring", parsed frames are written once into the ring and the
+        messages carry only the frame's "sequence" number instead of "data". Subscribers read the frames from the ring.
+        Otherwise messages carry both, with sequence numbers counted by the Reader.
+
+        Each message is passed to on_data in the main process, if it is set.
+    """
+    def __init__(self, *args, **kwargs):
+        tag = kwargs.pop("tag")
+        Producer.__init__(self, *args, **kwargs)
+        # Counts of malformed and truncated frames, updated by the reader process
+        self.frame_errors = Array(ctypes.c_longlong, 2)
+        self.work_kwargs = {"tag": tag, "frame_errors": self.frame_errors}
+        self.on_connect_failed = None
+        self.on_connect_succeeded = None
+        self.on_data = None
+
+    @staticmethod
+    def on_start(state, message_pipe, *args, **kwargs):
+        device_name = kwargs["device_name"]
+        configuration = kwargs["configuration"]
+        kwargs["frame_errors"][:] = [0, 0]
+        try:
+            if is_virtual_device(device_name):
+                device = open_virtual_device(device_name, configuration.get("virtual_device", {}),
+                                             timeout=configuration["read_timeout"])
+            else:
+                device = serial.Serial(port=device_name, baudrate=configuration["baud"],
+                                       timeout=configuration["read_timeout"])
+            device.flushInput()
+            message_pipe.send("connect succeeded")
+        except (serial.SerialException, OSError, ValueError) as e:
+            device = None
+            print(e)
+            state.value = Producer.stopped
+            message_pipe.send("connect failed")
+        frame_buffer = FrameBuffer(termination=configuration.get("read_termination_char", "\n"),
+                                   start_char=configuration["frame_start_char"], encoding=configuration["encoding"],
+                                   max_frame_length=configuration.get("max_frame_length", 65536))
+        return {"configuration": configuration, "device": device, "frame_buffer": frame_buffer, "n_sent": 0,
+                "last_read": time()}
+
+    @staticmethod
+    def on_stop(shared_var, state, message_pipe, *args, **kwargs):
+        frame_buffer = shared_var["frame_buffer"]
+        frame_buffer.close()
+        kwargs["frame_errors"][:] = [frame_buffer.n_malformed, frame_buffer.n_truncated]
+        print("Reader stopped. {} frames, {} malformed, {} truncated".format(
+            frame_buffer.n_frames, frame_buffer.n_malformed, frame_buffer.n_truncated))
+        device = shared_var["device"]
+        if device is not None:
+            try:
+                device.close()
+            except serial.SerialException as e:
+                print(e)
+                pass
+        pass
+
+    @staticmethod
+    def work(shared_var, state, message_pipe, *args, **kwargs):
+        tag = kwargs["tag"]
+        frame_ring = kwargs.get("frame_ring")
+        device = shared_var["device"]
+        configuration = shared_var["configuration"]
+        frame_buffer = shared_var["frame_buffer"]
+
+        try:
+            # Read everything waiting in one go. If nothing is waiting, block (up to the read timeout) for the next byte
+            data = device.read(max(1, device.in_waiting))
+        except serial.SerialException as e:
+            state.value = Producer.stopped
+            print(e)
+            return None
+        read_time = perf_counter_ns()
+        read_end = time()
+
+        frames, timestamps = frame_buffer.feed_timed(data, shared_var["last_read"], read_end)
+        shared_var["last_read"] = read_end
+        parse = configuration.get("parse_frames", False) or frame_ring is not None
+
+        messages = []
+        for frame, timestamp in zip(frames, timestamps):
+            stage_times = {"read": read_time}
+            if parse:
+                frame = parse_oeit_line(frame)
+                if frame is None:
+                    frame_buffer.n_malformed += 1
+                    continue
+                stamp(stage_times, "parse")
+
+            if frame_ring is not None:
+                sequence = frame_ring.write(frame, timestamp)
+                if sequence is None:
+                    frame_buffer.n_malformed += 1
+                    continue
+                messages.append({"tag": tag, "sequence": sequence, "timestamp": timestamp,
+                                 "stage_times": stage_times})
+            else:
+                messages.append({"tag": tag, "data": frame, "sequence": shared_var["n_sent"], "timestamp": timestamp,
+                                 "stage_times": stage_times})
+                shared_var["n_sent"] += 1
+
+        kwargs["frame_errors"][:] = [frame_buffer.n_malformed, frame_buffer.n_truncated]
+        if len(messages) == 0:
+            return None
+        return messages
+
+    def on_result_ready(self, result):
+        if result is not None:
+            for message in result:
+                self.emit_data(message)
+
+    def emit_data(self, message):
+        if self.on_data is not None:
+            self.on_data(message)
+
+    def get_frame_errors(self):
+        malformed, truncated = self.frame_errors[:]
+        return {"malformed": malformed, "truncated": truncated}
+
+    def on_message_ready(self, message):
+        if message == "connect failed":
+            if self.on_connect_failed is not None:
+                self.on_connect_failed()
+        if message == "connect succeeded":
+            if self.on_connect_succeeded is not None:
+                self.on_connect_succeeded()
+
+    @staticmethod
+    def list_devices(replay_files=()):
+        device_names = [port.name for port in list_ports.comports()]
+        device_names.append(virtual_device_name)
+        device_names.extend(replay_device_prefix + file_name for file_name in replay_files)
+        return device_names
+
+
+class EITProcessorWorker(Consumer):
+    """
+    Reconstructs EIT images from Reader or FrameMerger messages (only those of work kwarg "tag", if set).
+
+    The geometry is sent once per session (on_geometry), then each image (on_image) carries only the node values and
+    the frame's tag, timestamp and sequence. Lossy, only the newest frame is reconstructed. Lossless, every frame is,
+    by a ReconstructionPool, in order. A "filter", "background_average" or the "solve" summaries (on_summaries, if
+    work kwarg "summaries" is set) need every frame, so the processor then reads all of them from the FrameRing and
+    only reconstructs the newest.
+
+    The reconstruction object is work kwarg "eit_obj", or it is set up in the worker process from the "mesh" and
+    "eit_setup" files, in which case n_channels can be None and the frames stay inside the worker process.
+    """
+    def __init__(self, n_channels, lossless=False, n_workers=None, max_pending=None, *args, **kwargs):
+        if lossless:
+            Consumer.__init__(self, lossy_queue=False, maxsize=1000, *args, **kwargs)
+        else:
+            Consumer.__init__(self, lossy_queue=True, maxsize=1, *args, **kwargs)
+        # Background and current frame are shared with the worker process through shared memory, so reading and
+        # publishing them costs a copy instead of a round trip to a manager process.
+        self.background = None if n_channels is None else SharedFrame(n_channels)
+        self.current_frame = None if n_channels is None else SharedFrame(n_channels)
+        self.record_images = Value(ctypes.c_bool, False)
+        self.recording_name = Array(ctypes.c_char, 4096)
+        self.background_requested = Value(ctypes.c_bool, False)
+        # Frames lost by a processor that reads every frame from the FrameRing, updated by the processor process
+        self.n_dropped = Value(ctypes.c_longlong, 0)
+        self.work_kwargs = {"background": self.background, "current_frame": self.current_frame, "lossless": lossless,
+                            "n_workers": n_workers, "max_pending": max_pending, "record_images": self.record_images,
+                            "recording_name": self.recording_name, "background_requested": self.background_requested,
+                            "n_dropped": self.n_dropped}
+        self.on_image = None
+        self.on_geometry = None
+        self.on_summaries = None
+        self.on_background_set = None
+
+    @staticmethod
+    def on_start(state, message_pipe, *args, **kwargs):
+        conf = kwargs["configuration"]
+        conf = load_conf(conf)
+        kwargs["n_dropped"].value = 0
+        # Read from the frames written from now on, also those written while the reconstruction object is set up
+        ring_cursor = create_ring_cursor(kwargs, lossy=False)
+
+        eit_obj = kwargs.get("eit_obj")
+        if eit_obj is None:
+            eit_obj = setup_eit(kwargs["mesh"], kwargs["eit_setup"])
+        message_pipe.send({"geometry": mesh_geometry(eit_obj)})
+
+        background = kwargs["background"]
+        current_frame = kwargs["current_frame"]
+        if background is None:
+            n_channels = eit_obj.fwd.protocol.n_meas_tot
+            background, current_frame = SharedFrame(n_channels), SharedFrame(n_channels)
+        background_average = create_rolling_average(conf)
+        initial_background = kwargs["initial_bg"]
+        if initial_background is not None:
+            n_frames = 1 if background_average is None or background_average.n_frames is None \
+                else background_average.n_frames
+            background.set(load_background(initial_background, n_frames))
+        else:
+            background.set(None)
+
+        if "filter" in conf and not kwargs["lossless"] and kwargs.get("frame_ring") is None:
+            print("Frames the EIT processor skips are left out of the filter, set lossless to filter every frame")
+
+        shared_var = {"conf": conf, "eit_obj": eit_obj, "shared_background": background, "current_frame": current_frame,
+                      "ring_cursor": ring_cursor,
+                      "background_version": None, "background": None, "reconstruction_pool": None, "solver": None,
+                      "interpolation": None, "summaries": None, "frame_filter": create_frame_filter(conf),
+                      "background_average": background_average,
+                      "image_recorder": None, "recorded_background_version": None,
+                      # The pool's thread records images while work may close the recorder
+                      "image_recorder_lock": threading.Lock(),
+                      # The pool's thread sends results while work sends summaries, and a pipe isn't thread safe
+                      "message_lock": threading.Lock()}
+
+        if kwargs["lossless"]:
+            # Results are forwarded to the main process (and recorded) by the pool as they complete, in order
+            def forward_result(result):
+                EITProcessorWorker.record_image(shared_var, result)
+                with shared_var["message_lock"]:
+                    message_pipe.send({"result": result})
+
+            shared_var["reconstruction_pool"] = ReconstructionPool(eit_obj, conf, forward_result,
+                                                                   n_workers=kwargs["n_workers"],
+                                                                   max_pending=kwargs["max_pending"])
+        else:
+            shared_var["solver"] = create_solver(eit_obj, conf)
+            shared_var["interpolation"] = create_interpolation(eit_obj, conf)
+        if kwargs.get("summaries", False):
+            shared_var["summaries"] = create_summaries(eit_obj, conf, shared_var["solver"], shared_var["interpolation"])
+        # The filter, summaries and background average need every frame, so then even a lossy processor reads them all
+        # from the ring
+        every_frame = any(shared_var[key] is not None for key in ("frame_filter", "summaries", "background_average"))
+        if ring_cursor is not None:
+            ring_cursor.lossy = not (kwargs["lossless"] or every_frame)
+        return shared_var
+
+    @staticmethod
+    def on_stop(shared_var, state, message_pipe, *args, **kwargs):
+        if shared_var["reconstruction_pool"] is not None:
+            shared_var["reconstruction_pool"].close()
+        if shared_var["image_recorder"] is not None:
+            EITProcessorWorker.close_image_recorder(shared_var)
+        ring_cursor = shared_var["ring_cursor"]
+        if ring_cursor is not None and ring_cursor.dropped > 0:
+            print("EIT processor {} {} frames".format("skipped" if ring_cursor.lossy else "dropped", ring_cursor.dropped))
+        # Only frees the frames if they were created in this process (n_channels None), atexit doesn't run in workers
+        shared_var["shared_background"].unlink()
+        shared_var["current_frame"].unlink()
+
+    def set_background(self, background):
+        self.background.set(background)
+
+    def get_background(self):
+        return self.background.get()
+
+    def set_current_frame(self, frame):
+        self.current_frame.set(frame)
+
+    def get_current_frame(self):
+        return self.current_frame.get()
+
+    def request_background(self):
+        """
+        Set the background to the mean of the latest frames ("background_average", see filters.RollingAverage) or to
+        the current frame, once one arrives. on_background_set gets {"n_frames": ..., "seconds": ...} when it is set.
+        """
+        self.background_requested.value = True
+
+    def get_dropped(self):
+        return self.n_dropped.value
+
+    def cancel_background_request(self):
+        """
+        Cancel a request_background the processor hasn't handled yet. Returns True if there was one.
+        """
+        with self.background_requested.get_lock():
+            pending = self.background_requested.value
+            self.background_requested.value = False
+        return pending
+
+    def start_image_recording(self, recording_name):
+        """
+        Record the images, and the backgrounds they were reconstructed against, next to the raw recording
+        recording_name (its file name without the extension), with the mesh geometry in <recording>_geometry.json.
+        """
+        self.recording_name.value = recording_name.encode()
+        self.record_images.value = True
+
+    def stop_image_recording(self):
+        self.record_images.value = False
+
+    @staticmethod
+    def update_image_recorder(shared_var, kwargs):
+        if kwargs["record_images"].value and shared_var["image_recorder"] is None:
+            configuration = kwargs["recording_configuration"]
+            extension = configuration.get("image_extension", ".eitimg")
+            recording_name = kwargs["recording_name"].value.decode()
+            eit_obj = shared_var["eit_obj"]
+            geometry_file = recording_name + "_geometry.json"
+            try:
+                image_file = DataSaver.open_save_file(recording_name + extension, binary=True)
+                background_file = DataSaver.open_save_file(recording_name + "_backgrounds" + extension, binary=True)
+                with open(geometry_file, "x") as f:
+                    json.dump({key: np.asarray(value).tolist() for key, value in mesh_geometry(eit_obj).items()}, f)
+            except FileExistsError as e:
+                print(e)
+                kwargs["record_images"].value = False
+                return
+            metadata = {"conf": shared_var["conf"], "geometry_file": os.path.basename(geometry_file)}
+            shared_var["image_recorder"] = ImageRecorder(image_file, background_file, len(eit_obj.mesh.node),
+                                                         eit_obj.fwd.protocol.n_meas_tot, metadata,
+                                                         configuration.get("flush_interval", 1),
+                                                         image_dtype=reconstruction_dtype(shared_var["conf"]))
+            shared_var["recorded_background_version"] = None
+        elif not kwargs["record_images"].value and shared_var["image_recorder"] is not None:
+            EITProcessorWorker.close_image_recorder(shared_var)
+
+    @staticmethod
+    def close_image_recorder(shared_var):
+        with shared_var["image_recorder_lock"]:
+            image_recorder = shared_var["image_recorder"]
+            shared_var["image_recorder"] = None
+            image_recorder.close()
+        print("Recorded {} images to {}".format(image_recorder.n_images, image_recorder.name))
+        if image_recorder.n_dropped > 0:
+            print("Image recording fell behind, {} images not recorded".format(image_recorder.n_dropped))
+
+    @staticmethod
+    def record_image(shared_var, result):
+        with shared_var["image_recorder_lock"]:
+            image_recorder = shared_var["image_recorder"]
+            if image_recorder is not None:
+                eit_image, frame_info = result
+                image_recorder.add_image(frame_info.get("sequence", -1), frame_info.get("timestamp", 0),
+                                         frame_info["background_version"], eit_image)
+
+    @staticmethod
+    def run_frame_stages(items, background, shared_var, message_pipe):
+        """
+        Run the stages that need every frame on all frames of a work call at once: the filter, the background average
+        and the summaries. Returns the items, with their filtered frames if there is a filter. Items without a frame of
+        the right size are dropped.
+        """
+        frame_filter = shared_var["frame_filter"]
+        background_average = shared_var["background_average"]
+        summaries = shared_var["summaries"]
+        if frame_filter is None and background_average is None and summaries is None:
+            return items
+
+        items, frames = stack_frames(items, shared_var["current_frame"].n_channels)
+        if frames is None:
+            return []
+        if frame_filter is not None:
+            frames = frame_filter.filter(frames)
+            items = [{**item, "data": frame} for item, frame in zip(items, frames)]
+        timestamps = np.array([item.get("timestamp", 0) for item in items])
+        if background_average is not None:
+            background_average.add(timestamps, frames)
+        if summaries is not None:
+            values = summaries.summarize(frames, np.zeros(frames.shape[1]) if background is None else background)
+            message = {"summaries": {"names": summaries.names, "values": values, "timestamp": timestamps,
+                                     "sequence": np.array([item.get("sequence", -1) for item in items])}}
+            with shared_var["message_lock"]:
+                message_pipe.send(message)
+        return items
+
+    @staticmethod
+    def set_requested_background(shared_var, message_pipe):
+        """
+        Set the background to the mean of the latest frames, or to the current frame without a background average.
+        Returns False if there is no frame yet.
+        """
+        background_average = shared_var["background_average"]
+        if background_average is not None:
+            background = background_average.mean()
+            background_set = {"n_frames": len(background_average), "seconds": background_average.duration()}
+        else:
+            background = shared_var["current_frame"].get()
+            background_set = {"n_frames": 1, "seconds": 0}
+        if background is None:
+            return False
+
+        shared_var["shared_background"].set(background)
+        with shared_var["message_lock"]:
+            message_pipe.send({"background_set": background_set})
+        return True
+
+    @staticmethod
+    def work(items, shared_var, state, message_pipe, *args, **kwargs):
+        eit_obj = shared_var["eit_obj"]
+        current_frame = shared_var["current_frame"]
+        conf = shared_var["conf"]
+
+        background_requested = kwargs["background_requested"]
+        with background_requested.get_lock():
+            if background_requested.value and EITProcessorWorker.set_requested_background(shared_var, message_pipe):
+                background_requested.value = False
+
+        # Only copy the background out of shared memory when it has changed
+        background_version = shared_var["shared_background"].get_version()
+        if background_version != shared_var["background_version"]:
+            shared_var["background"] = shared_var["shared_background"].get()
+            shared_var["background_version"] = background_version
+        background = shared_var["background"]
+
+        EITProcessorWorker.update_image_recorder(shared_var, kwargs)
+        image_recorder = shared_var["image_recorder"]
+        if image_recorder is not None and shared_var["recorded_background_version"] != background_version:
+            image_recorder.add_background(background_version, time(), background)
+            shared_var["recorded_background_version"] = background_version
+
+        reconstruction_pool = shared_var["reconstruction_pool"]
+        items = collect_items(items, shared_var)
+        ring_cursor = shared_var["ring_cursor"]
+        if ring_cursor is not None and not ring_cursor.lossy:
+            kwargs["n_dropped"].value = ring_cursor.dropped
+        if kwargs.get("tag") is not None:
+            items = select_tag(items, kwargs["tag"])
+        items = EITProcessorWorker.run_frame_stages(items, background, shared_var, message_pipe)
+        if reconstruction_pool is None:
+            # The processor is lossy: only the newest frame is reconstructed
+            items = items[-1:]
+
+        results = []
+        for item in items:
+            if item is not None:
+                data = item_frame(item)
+                if data is not None:
+                    current_frame.set(data)
+                    frame_info = {key: item[key] for key in ("tag", "timestamp", "sequence") if key in item}
+                    frame_info["stage_times"] = dict(item.get("stage_times", {}))
+                    frame_info["background_version"] = background_version
+                    if reconstruction_pool is not None:
+                        reconstruction_pool.submit(data, background, frame_info)
+                    else:
+                        eit_image = process_frame(eit_obj, data, conf, background, frame_info["stage_times"],
+                                                  shared_var["solver"], shared_var["interpolation"])
+                        EITProcessorWorker.record_image(shared_var, (eit_image, frame_info))
+                        results.append((eit_image, frame_info))
+
+        return results
+
+    def on_result_ready(self, result):
+        if result is not None and len(result) > 0:
+            # EIT data comes in one at at time
+            stamp(result[0][1]["stage_times"], "ui")
+            self.emit_image(result[0])
+
+    def on_message_ready(self, message):
+        if isinstance(message, dict) and "geometry" in message:
+            self.emit_geometry(message["geometry"])
+        if isinstance(message, dict) and "result" in message:
+            stamp(message["result"][1]["stage_times"], "ui")
+            self.emit_image(message["result"])
+        if isinstance(message, dict) and "summaries" in message:
+            self.emit_summaries(message["summaries"])
+        if isinstance(message, dict) and "background_set" in message:
+            self.emit_background_set(message["background_set"])
+
+    def emit_image(self, result):
+        if self.on_image is not None:
+            self.on_image(result)
+
+    def emit_geometry(self, geometry):
+        if self.on_geometry is not None:
+            self.on_geometry(geometry)
+
+    def emit_summaries(self, summaries):
+        if self.on_summaries is not None:
+            self.on_summaries(summaries)
+
+    def emit_background_set(self, background_set):
+        if self.on_background_set is not None:
+            self.on_background_set(background_set)
+
+
+class FrameMerger(Consumer):
+    """
+    Aligns the frames of several Readers, each reading one device with its own tag, by their timestamps.
+
+    The Readers subscribe to the merger's queue, and downstream Consumers to the merger with set_subscribers. Frames
+    within tolerance seconds of the oldest pending frame are grouped into one message:
+        { "tag": "merged"
+          "timestamp": timestamp of the oldest frame in the group
+          "frames": {tag: Reader message} }
+    and lists of these are put into the subscriber queues, like a Reader's messages, and passed to on_data in the main
+    process.
+
+    A group is sent once every device has a frame in it. A device whose next frame is already too late for the group,
+    or that has sent nothing for max_delay seconds, is left out of it, so a slow or stalled device doesn't hold up the
+    others.
+
+    When the queue of a lossless subscriber is full, the merger waits up to max_delay seconds for room. Groups that
+    still don't fit are dropped and counted (get_dropped).
+    """
+    def __init__(self, tags, tolerance=0.01, max_delay=0.5):
+        Consumer.__init__(self, work_timeout=0.1, max_buffer_size=1, lossy_queue=False, maxsize=1000)
+        # Number of groups dropped because a subscriber queue was full, updated by the merger process
+        self.n_dropped = Value(ctypes.c_longlong, 0)
+        self.work_kwargs = {"tags": tags, "tolerance": tolerance, "max_delay": max_delay, "subscribers": [],
+                            "n_dropped": self.n_dropped}
+        self.on_data = None
+
+    def set_subscribers(self, subscriber_queues):
+        self.work_kwargs["subscribers"] = subscriber_queues
+
+    @staticmethod
+    def on_start(state, message_pipe, *args, **kwargs):
+        kwargs["n_dropped"].value = 0
+        return {"pending": {tag: deque() for tag in kwargs["tags"]}, "n_groups": 0,
+                "n_missing": {tag: 0 for tag in kwargs["tags"]}}
+
+    @staticmethod
+    def on_stop(shared_var, state, message_pipe, *args, **kwargs):
+        # Send what is left, without waiting for the other devices
+        FrameMerger.publish(FrameMerger.merge(shared_var, kwargs["tolerance"], 0, float("inf")), kwargs)
+        print("Frame merger stopped. {} groups ({} dropped), missing frames: {}".format(
+            shared_var["n_groups"], kwargs["n_dropped"].value, shared_var["n_missing"]))
+
+    @staticmethod
+    def work(items, shared_var, state, message_pipe, *args, **kwargs):
+        pending = shared_var["pending"]
+        for message in collect_items(items, shared_var):
+            if message["tag"] in pending:
+                pending[message["tag"]].append(message)
+
+        groups = FrameMerger.merge(shared_var, kwargs["tolerance"], kwargs["max_delay"], time())
+        FrameMerger.publish(groups, kwargs)
+        if len(groups) == 0:
+            return None
+        return groups
+
+    @staticmethod
+    def merge(shared_var, tolerance, max_delay, now):
+        pending = shared_var["pending"]
+        groups = []
+        while any(len(frames) > 0 for frames in pending.values()):
+            heads = {tag: frames[0] for tag, frames in pending.items() if len(frames) > 0}
+            reference = min(message["timestamp"] for message in heads.values())
+            # Devices without a pending frame could still send one that belongs in this group
+            if len(heads) < len(pending) and now - reference < max_delay:
+                break
+
+            members = {tag: message for tag, message in heads.items() if message["timestamp"] - reference <= tolerance}
+            for tag in pending:
+                if tag in members:
+                    stamp(pending[tag].popleft().get("stage_times"), "merge")
+                else:
+                    shared_var["n_missing"][tag] += 1
+            groups.append({"tag": "merged", "timestamp": reference, "frames": members})
+
+        shared_var["n_groups"] += len(groups)
+        return groups
+
+    @staticmethod
+    def publish(groups, kwargs):
+        if len(groups) == 0:
+            return
+        for subscriber in kwargs["subscribers"]:
+            if not subscriber.is_ready():
+                continue
+            try:
+                # A lossy queue makes room itself, a lossless one is given max_delay to make room
+                subscriber.put(groups, timeout=kwargs["max_delay"])
+            except queue.Full:
+                kwargs["n_dropped"].value += len(groups)
+
+    def on_result_ready(self, result):
+        if result is not None:
+            for group in result:
+                self.emit_data(group)
+
+    def get_dropped(self):
+        return self.n_dropped.value
+
+    def emit_data(self, group):
+        if self.on_data is not None:
+            self.on_data(group)
+
+
+class DataSaver(Consumer):
+    """
+    Records Reader messages to a csv or binary file. FrameMerger messages are recorded with the frames of all their
+    devices in one row (csv) or record (binary, see recording.merged_record_dtype).
+
+    After every write, the stage_times of the frames written (with their "write" time added) are sent to the main
+    process and passed to on_stage_times, if it is set.
+
+    Recordings are gzip compressed as they are written if configuration["compression"] is "gzip". If "rotate_size"
+    (bytes) or "rotate_duration" (seconds) is set, the recording is split into numbered segments of at most that size
+    or duration, each a complete recording on its own, and a manifest listing the segments with the time range of
+    their frames is kept next to them (see write_manifest).
+
+    Once the file is created, the recording's name without extension (and segment number) is passed to
+    on_recording_started, if it is set.
+    """
+    def __init__(self, buffer_size=1, buffer_timeout=0):
+        Consumer.__init__(self, buffer_size, buffer_timeout)
+        self.filename = Array(ctypes.c_char, 4096)
+        # Frames the FrameRing overwrote before they were recorded, updated by the saver process
+        self.n_dropped = Value(ctypes.c_longlong, 0)
+        self.work_kwargs = {"filename": self.filename, "n_dropped": self.n_dropped}
+        self.on_stage_times = None
+        self.on_recording_started = None
+
+    @staticmethod
+    def create_unique_save_file(suffix, data_saving_configuration, extension=None, binary=False, compression=None,
+                                segment=None):
+        """
+        Create a new file in the configured directory, named after the date and suffix, with "_1", "_2", ... added if
+        that name is taken. The name is claimed by creating the file in exclusive mode, so two recordings started at the
+        same time can't end up in the same file.
+        """
+        directory = data_saving_configuration["directory"]
+        date_format = data_saving_configuration["format"]
+        default_suffix = data_saving_configuration["default_suffix"]
+        ext = data_saving_configuration["extension"] if extension is None else extension
+
+        if suffix == "":
+            suffix = default_suffix
+
+        os.makedirs(directory, exist_ok=True)
+
+        file_name = directory + datetime.now().strftime(date_format) + "_" + suffix
+        addition = ""
+
+        i = 1
+        while True:
+            try:
+                return DataSaver.open_save_file(DataSaver.save_file_name(file_name + addition, ext, compression, segment),
+                                                binary, compression,
+                                                data_saving_configuration.get("compression_level", 6))
+            except FileExistsError:
+                addition = "_" + str(i)
+                i += 1
+
+    @staticmethod
+    def save_file_name(base_name, extension, compression=None, segment=None):
+        if segment is not None:
+            base_name += "_{:03d}".format(segment)
+        return base_name + extension + (".gz" if compression == "gzip" else "")
+
+    @staticmethod
+    def open_save_file(file_name, binary=False, compression=None, compression_level=6):
+        if compression == "gzip":
+            if binary:
+                return gzip.open(file_name, "xb", compresslevel=compression_level)
+            return gzip.open(file_name, "xt", compresslevel=compression_level, newline="")
+        if compression is not None:
+            raise ValueError("Unknown compression: " + str(compression))
+        if binary:
+            return open(file_name, "xb")
+        return open(file_name, "x", newline="")
+
+    @staticmethod
+    def on_start(state, message_pipe, *args, **kwargs):
+        suffix = kwargs["suffix"]
+        data_saving_configuration = kwargs["configuration"]
+        kwargs["n_dropped"].value = 0
+
+        binary = data_saving_configuration.get("file_type", "csv") == "binary"
+        extension = data_saving_configuration["binary_extension"] if binary else data_saving_configuration["extension"]
+        compression = data_saving_configuration.get("compression")
+        rotate = data_saving_configuration.get("rotate_size") is not None or \
+            data_saving_configuration.get("rotate_duration") is not None
+        segment = 1 if rotate else None
+
+        file = DataSaver.create_unique_save_file(suffix, data_saving_configuration, extension=extension, binary=binary,
+                                                 compression=compression, segment=segment)
+        # The name all segments share, including the "_1", "_2", ... that made it unique
+        base_name = file.name[:len(file.name) - len(DataSaver.save_file_name("", extension, compression, segment))]
+        shared_var = {"binary": binary, "extension": extension, "compression": compression, "rotate": rotate,
+                      "base_name": base_name, "segments": [], "ring_cursor": create_ring_cursor(kwargs, lossy=False)}
+        DataSaver.start_segment(file, shared_var, kwargs)
+        message_pipe.send({"recording": base_name})
+        return shared_var
+
+    @staticmethod
+    def start_segment(file, shared_var, kwargs):
+        data_saving_configuration = kwargs["configuration"]
+        kwargs["filename"].value = file.name.encode()
+        shared_var["file"] = file
+        shared_var["segments"].append({"file": os.path.basename(file.name), "start": None, "end": None,
+                                       "n_frames": 0})
+
+        if shared_var["binary"]:
+            shared_var["recording_writer"] = ChunkedRecordingWriter(
+                file, metadata=kwargs.get("metadata"), flush_interval=data_saving_configuration.get("flush_interval", 1))
+            return
+
+        csv_writer = csv.writer(file, delimiter=data_saving_configuration["delimiter"], quoting=csv.QUOTE_MINIMAL)
+        csv_writer.writerow(data_saving_configuration["columns"])
+        # TODO Write file with header section
+        shared_var["csv_writer"] = csv_writer
+        shared_var["last_flush"] = time()
+
+    @staticmethod
+    def end_segment(shared_var):
+        if "recording_writer" in shared_var:
+            shared_var["recording_writer"].close()
+        else:
+            shared_var["file"].close()
+        shared_var["segments"][-1]["bytes"] = os.path.getsize(shared_var["file"].name)
+
+    @staticmethod
+    def rotate_if_due(shared_var, kwargs):
+        data_saving_configuration = kwargs["configuration"]
+        rotate_size = data_saving_configuration.get("rotate_size")
+        rotate_duration = data_saving_configuration.get("rotate_duration")
+        segment = shared_var["segments"][-1]
+        if not shared_var["rotate"] or segment["n_frames"] == 0:
+            return
+        # Data still buffered in the writer isn't counted, so segments can exceed rotate_size by up to one flush
+        if (rotate_size is not None and os.fstat(shared_var["file"].fileno()).st_size >= rotate_size) or \
+                (rotate_duration is not None and segment["end"] - segment["start"] >= rotate_duration):
+            DataSaver.end_segment(shared_var)
+            file = DataSaver.open_save_file(
+                DataSaver.save_file_name(shared_var["base_name"], shared_var["extension"], shared_var["compression"],
+                                         len(shared_var["segments"]) + 1),
+                shared_var["binary"], shared_var["compression"], data_saving_configuration.get("compression_level", 6))
+            DataSaver.start_segment(file, shared_var, kwargs)
+            DataSaver.write_manifest(shared_var, data_saving_configuration)
+
+    @staticmethod
+    def write_manifest(shared_var, data_saving_configuration):
+        """
+        Write the manifest of a rotated recording, <base name>.manifest.json, listing for each segment its file, the
+        timestamps of its first and last frame ("start", "end"), its number of frames and, once it is complete, its
+        size in bytes. The manifest is replaced atomically, so it is always complete.
+        """
+        manifest = {"file_type": "binary" if shared_var["binary"] else "csv",
+                    "compression": shared_var["compression"],
+                    "columns": data_saving_configuration["columns"],
+                    "segments": shared_var["segments"]}
+        manifest_file = shared_var["base_name"] + ".manifest.json"
+        with open(manifest_file + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(manifest_file + ".tmp", manifest_file)
+
+    @staticmethod
+    def record_segment_frames(shared_var, buffer, n_frames):
+        segment = shared_var["segments"][-1]
+        if len(buffer) > 0 and n_frames > 0:
+            if segment["start"] is None:
+                segment["start"] = buffer[0]["timestamp"]
+            segment["end"] = buffer[-1]["timestamp"]
+            segment["n_frames"] += n_frames
+
+    @staticmethod
+    def on_stop(shared_var, state, message_pipe, *args, **kwargs):
+        DataSaver.end_segment(shared_var)
+        if kwargs["n_dropped"].value > 0:
+            print("{} frames were overwritten in the frame ring before they were recorded".format(
+                kwargs["n_dropped"].value))
+        if shared_var["rotate"]:
+            DataSaver.write_manifest(shared_var, kwargs["configuration"])
+
+    def get_dropped(self):
+        return self.n_dropped.value
+
+    def get_filename(self):
+        if not self.filename.value:
+            return None
+        return self.filename.value.decode()
+
+    @staticmethod
+    def work(buffer, shared_var, state, message_pipe, *args, **kwargs):
+        buffer = collect_items(buffer, shared_var)
+        if shared_var["ring_cursor"] is not None:
+            kwargs["n_dropped"].value = shared_var["ring_cursor"].dropped
+
+        data_saving_configuration = kwargs["configuration"]
+
+        if "recording_writer" in shared_var:
+            n_frames = DataSaver.write_binary(buffer, shared_var["recording_writer"], data_saving_configuration)
+            DataSaver.send_stage_times(buffer, message_pipe)
+            DataSaver.record_segment_frames(shared_var, buffer, n_frames)
+            DataSaver.rotate_if_due(shared_var, kwargs)
+            return n_frames
+
+        file = shared_var["file"]
+        csv_writer = shared_var["csv_writer"]
+
+        output_list = []
+        for item in buffer:
+            timestamp = item["timestamp"]
+
+            if "timestamp_format" in data_saving_configuration and data_saving_configuration[
+                    "timestamp_format"] is not None:
+                if data_saving_configuration["timestamp_format"] == "raw":
+                    time_string = str(timestamp)
+                else:
+                    time_string = timestamp.strftime(data_saving_configuration["timestamp_format"])
+            else:
+                time_string = None
+
+            columns = data_saving_configuration["columns"]
+            output = [None] * len(columns)
+            if "Time" in columns:
+                output[columns.index("Time")] = time_string
+
+            for message in member_messages(item):
+                if message["tag"] in columns:
+                    output[columns.index(message["tag"])] = item_text(message)
+
+            output_list.append(output)
+
+        csv_writer.writerows(output_list)
+        if time() - shared_var["last_flush"] >= data_saving_configuration.get("flush_interval", 0):
+            file.flush()
+            shared_var["last_flush"] = time()
+        DataSaver.send_stage_times(buffer, message_pipe)
+        DataSaver.record_segment_frames(shared_var, buffer, len(output_list))
+        DataSaver.rotate_if_due(shared_var, kwargs)
+        return output_list
+
+    @staticmethod
+    def send_stage_times(buffer, message_pipe):
+        write_time = perf_counter_ns()
+        stage_times = [{**message["stage_times"], "write": write_time} for item in buffer
+                       for message in member_messages(item) if "stage_times" in message]
+        if len(stage_times) > 0:
+            message_pipe.send({"stage_times": stage_times})
+
+    def on_message_ready(self, message):
+        if isinstance(message, dict) and "stage_times" in message and self.on_stage_times is not None:
+            self.on_stage_times(message["stage_times"])
+        if isinstance(message, dict) and "recording" in message and self.on_recording_started is not None:
+            self.on_recording_started(message["recording"])
+
+    @staticmethod
+    def write_binary(buffer, recording_writer, data_saving_configuration):
+        """
+        Parse the frames in buffer and append them to the binary recording in one bulk write. Only items tagged with one
+        of the configured columns are recorded.
+
+        Returns the number of frames recorded
+        """
+        columns = data_saving_configuration["columns"]
+        if len(buffer) > 0 and "frames" in buffer[0]:
+            tags = [column for column in columns if column != "Time"]
+            groups = [{tag: item_frame(message) for tag, message in item["frames"].items() if tag in tags}
+                      for item in buffer]
+            recording_writer.append_merged([item["timestamp"] for item in buffer], groups, tags)
+            return len(groups)
+
+        timestamps = []
+        frames = []
+        for item in buffer:
+            if item["tag"] not in columns:
+                continue
+            frame = item_frame(item)
+            if frame is not None:
+                timestamps.append(item["timestamp"])
+                frames.append(frame)
+
+        recording_writer.append_frames(timestamps, frames)
+        return len(frames)
+
+
@@ -0,0 +1,19 @@
+import os
+import pytest
+import eit_data_acquisition
+from eit_data_acquisition.eit import setup_eit
+from eit_data_acquisition.virtual_device import simulated_frames
+
+configuration_dir = os.path.join(os.path.dirname(eit_data_acquisition.__file__), "configuration")
+mesh_file = os.path.join(configuration_dir, "circle_phantom_mesh_no_inclusion.stl")
+eit_setup_file = os.path.join(configuration_dir, "eit_setup.json")
+
+
+@pytest.fixture(scope="session")
+def eit_obj(tmp_path_factory):
+    return setup_eit(mesh_file, eit_setup_file, cache_directory=str(tmp_path_factory.mktemp("cache")))
+
+
+@pytest.fixture(scope="session")
+def frames(eit_obj):
+    return simulated_frames(eit_obj.fwd, frame_rate=10)[0]
@@ -0,0 +1,16 @@
+import json
+import os
+import subprocess
+import sys
+
+repository_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_benchmarks_run(tmp_path):
+    # A smoke test with the smallest sizes, so that changes to the workers can't break the benchmarks unnoticed
+    output = str(tmp_path / "results.json")
+    subprocess.run([sys.executable, os.path.join(repository_dir, "benchmarks", "run_benchmarks.py"), "--repeat", "1",
+                    "--frames", "20", "--output", output], check=True, cwd=str(tmp_path))
+    with open(output) as f:
+        benchmarks = json.load(f)["benchmarks"]
+    assert "data_saver_csv" in benchmarks and "data_saver_binary" in benchmarks
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+from eit_data_acquisition.eit import format_oeit_line, load_oeit_data, load_background
+
+
+def write_frames(file_name, lines):
+    with open(file_name, "w") as f:
+        f.write("".join(line + "\n" for line in lines))
+
+
+def test_load_background_skips_invalid_lines(tmp_path):
+    file_name = str(tmp_path / "background.txt")
+    frames = np.arange(12, dtype=float).reshape(3, 4)
+    # A line cut off before its prefix and a line with an item that isn't a number
+    write_frames(file_name, ["1.5, 2.5, 3", "magnitudes: 1, x, 3, 4"] + [format_oeit_line(frame) for frame in frames])
+    np.testing.assert_array_equal(load_background(file_name), frames[0])
+    np.testing.assert_array_equal(load_background(file_name, 2), frames[:2].mean(axis=0))
+    np.testing.assert_array_equal(load_oeit_data(file_name), frames)
+
+
+def test_load_background_needs_enough_frames(tmp_path):
+    file_name = str(tmp_path / "background.txt")
+    write_frames(file_name, ["magnitudes: 1, 2, 3", "garbage"])
+    with pytest.raises(ValueError, match="1 valid frames"):
+        load_background(file_name, 2)
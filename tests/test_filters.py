@@ -0,0 +1,47 @@
+import csv
+import os
+import argparse
+import numpy as np
+import eit_data_acquisition
+from eit_data_acquisition.__main__ import filter_recording
+from eit_data_acquisition.eit import format_oeit_line, load_conf
+from eit_data_acquisition.filters import FrameFilter
+from eit_data_acquisition.virtual_device import load_replay_frames
+
+breathing_conf = os.path.join("configuration", "conf_breathing.json")
+filter_conf = load_conf(os.path.join(os.path.dirname(eit_data_acquisition.__file__), breathing_conf))["filter"]
+
+
+def write_recording(file_name, timestamps, frames_by_tag):
+    with open(file_name, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Time"] + list(frames_by_tag))
+        for i, timestamp in enumerate(timestamps):
+            writer.writerow([timestamp] + [format_oeit_line(frames[i]) for frames in frames_by_tag.values()])
+
+
+def test_filter_frame_by_frame_matches_batch():
+    frames = np.random.default_rng(0).normal(size=(200, 8))
+    batch = FrameFilter(filter_conf).filter(frames)
+    frame_filter = FrameFilter(filter_conf)
+    stream = np.vstack([frame_filter.filter(frames[i:i + 7]) for i in range(0, len(frames), 7)])
+    np.testing.assert_allclose(stream, batch)
+
+
+def test_filtered_recording_replays(tmp_path):
+    rng = np.random.default_rng(1)
+    timestamps = 1.7e9 + np.arange(100) / filter_conf["frame_rate"]
+    frames = {"EIT": rng.normal(size=(100, 8)), "EIT2": 1 + rng.normal(size=(100, 8))}
+    recording = str(tmp_path / "recording.csv")
+    output = str(tmp_path / "filtered.csv")
+    write_recording(recording, timestamps, frames)
+
+    filter_recording(argparse.Namespace(recording=recording, output=output, tag="EIT2",
+                                        conf=breathing_conf))
+
+    with open(output, newline="") as f:
+        replay_timestamps = np.array([float(row[0]) for row in list(csv.reader(f))[1:]])
+    np.testing.assert_allclose(replay_timestamps, timestamps)
+    replay_frames, frame_times = load_replay_frames(output)
+    np.testing.assert_allclose(replay_frames, FrameFilter(filter_conf).filter(frames["EIT2"]))
+    np.testing.assert_allclose(frame_times, timestamps - timestamps[0], atol=1e-6)
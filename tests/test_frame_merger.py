@@ -0,0 +1,28 @@
+from multiprocessing import Value
+import ctypes
+from adv_prodcon.adv_prodcon import ReadyQueue
+from eit_data_acquisition.workers import FrameMerger
+
+
+def publish_kwargs(subscribers):
+    return {"subscribers": subscribers, "max_delay": 0.01, "n_dropped": Value(ctypes.c_longlong, 0)}
+
+
+def test_publish_counts_groups_dropped_by_full_lossless_queue():
+    subscriber = ReadyQueue(lossy=False, maxsize=1)
+    subscriber.set_ready()
+    kwargs = publish_kwargs([subscriber])
+    FrameMerger.publish([{"timestamp": 0}], kwargs)
+    FrameMerger.publish([{"timestamp": 1}, {"timestamp": 2}], kwargs)
+    assert kwargs["n_dropped"].value == 2
+    assert subscriber.get(timeout=1) == [{"timestamp": 0}]
+
+
+def test_publish_replaces_in_lossy_queue():
+    subscriber = ReadyQueue(lossy=True, maxsize=1)
+    subscriber.set_ready()
+    kwargs = publish_kwargs([subscriber])
+    FrameMerger.publish([{"timestamp": 0}], kwargs)
+    FrameMerger.publish([{"timestamp": 1}], kwargs)
+    assert kwargs["n_dropped"].value == 0
+    assert subscriber.get(timeout=1) == [{"timestamp": 1}]
@@ -0,0 +1,13 @@
+import pytest
+from eit_data_acquisition.framing import FrameBuffer
+
+
+def test_feed_timed_spreads_timestamps_over_the_read():
+    frame_buffer = FrameBuffer()
+    frames, timestamps = frame_buffer.feed_timed(b"abc\ndefg", 0.0, 8.0)
+    assert frames == ["abc"]
+    assert timestamps == [4.0]
+    # The rest of the second frame arrived with the first byte of this read
+    frames, timestamps = frame_buffer.feed_timed(b"\nhi\n", 8.0, 12.0)
+    assert frames == ["defg", "hi"]
+    assert timestamps == pytest.approx([9.0, 12.0])
@@ -0,0 +1,18 @@
+import numpy as np
+from eit_data_acquisition.linear_solver import LinearSolver
+
+
+def test_float32_matches_float64(eit_obj, frames):
+    background = frames[0]
+    double = LinearSolver(eit_obj, np.float64)
+    single = LinearSolver(eit_obj, np.float32)
+    for frame in frames[1:]:
+        image = double.solve(frame, background)
+        single_image = single.solve(frame, background)
+        assert single_image.dtype == np.float32
+        np.testing.assert_allclose(single_image, image, rtol=0, atol=1e-5 * np.max(np.abs(image)))
+
+
+def test_matches_jac_solve(eit_obj, frames):
+    image = LinearSolver(eit_obj).solve(frames[5], frames[0])
+    np.testing.assert_allclose(image, np.real(eit_obj.solve(frames[5], frames[0], normalize=False)))
@@ -0,0 +1,21 @@
+import numpy as np
+from eit_data_acquisition.recording import ChunkedRecordingWriter, ImageRecorder, load_recording
+
+
+def test_empty_recording_loads(tmp_path):
+    file_name = str(tmp_path / "empty.eitrec")
+    ChunkedRecordingWriter(open(file_name, "xb"), metadata={"device": "test"}).close()
+    records, metadata = load_recording(file_name)
+    assert len(records) == 0
+    assert metadata == {"device": "test"}
+
+
+def test_images_added_after_close_are_counted(tmp_path):
+    image_recorder = ImageRecorder(open(str(tmp_path / "images.eitimg"), "xb"),
+                                   open(str(tmp_path / "backgrounds.eitimg"), "xb"), n_nodes=3, n_channels=2)
+    image_recorder.add_image(0, 1.0, 0, np.zeros(3))
+    image_recorder.close()
+    image_recorder.add_image(1, 2.0, 0, np.zeros(3))
+    assert image_recorder.n_images == 1
+    assert image_recorder.n_dropped == 1
+    assert len(load_recording(str(tmp_path / "images.eitimg"))[0]) == 1
@@ -0,0 +1,24 @@
+import os
+from time import time
+import numpy as np
+import eit_data_acquisition
+from eit_data_acquisition.eit import load_conf, create_solver
+
+streaming_conf = os.path.join(os.path.dirname(eit_data_acquisition.__file__), "configuration", "conf_gn_streaming.json")
+
+
+def test_shipped_configuration_relinearizes_on_drift(eit_obj):
+    conf = load_conf(streaming_conf)
+    solver = create_solver(eit_obj, conf)
+    assert solver.time_budget is not None
+
+    perm = np.asarray(eit_obj.mesh.perm_array, dtype=float)
+    frame = eit_obj.fwd.solve_eit(perm=np.where(eit_obj.mesh.elem_centers[:, 0] > 0, 2 * perm, perm))
+    x_lin = solver.x_lin.copy()
+    deadline = time() + 120
+    while solver.n_relinearizations == 0 and time() < deadline:
+        solver.solve(frame)
+
+    assert solver.n_relinearizations == 1
+    assert np.linalg.norm(x_lin - solver.x_lin) > solver.relinearize_tolerance * np.linalg.norm(x_lin)
+    assert solver.relinearize_time > solver.time_budget